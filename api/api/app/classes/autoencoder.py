@@ -1,22 +1,13 @@
-import numpy as np
-import onnxruntime as runtime
+from classes.model_versions import model_versions, DEFAULT_VERSION
 
 
 class Autoencoder:
 
-    def __init__(self):
-        self.load_onnx_model()
-
-    
-    def load_onnx_model(self):
-        # This will load the model from the model folder
-        self.model = runtime.InferenceSession(".//model//lung-model.onnx")
+    def __init__(self, version=DEFAULT_VERSION):
+        # The model isn't loaded here anymore, the model registry loads it once on startup (other versions on first use)
+        self.model = model_versions.get(version)
 
 
     def predict(self, image):
-        # Get the input layer name
-        input_name = self.model.get_inputs()[0].name
-        # Get the output layer name
-        label_name = self.model.get_outputs()[0].name
-        # returns the prediction made with the lung image as input
-        return self.model.run([label_name], {input_name: image.astype(np.float32)})[0]
\ No newline at end of file
+        # returns the prediction made with the lung image as input - a session is borrowed from the pool of the registry
+        return self.model.predict(image)
@@ -0,0 +1,109 @@
+import time
+import asyncio
+
+import numpy as np
+
+import settings
+from classes.pipeline import infer
+from classes.executor import executor
+from classes.model_versions import DEFAULT_VERSION
+from classes.metrics import histogram, DURATION_BUCKETS
+
+
+class Batch_scheduler:
+
+    def __init__(self, executor, max_batch_size=settings.BATCH_MAX_SIZE, max_wait_ms=settings.BATCH_MAX_WAIT_MS):
+        # The scheduler collects the images of concurrent requests and lets the executor predict them as one batch,
+        # the dense layers of the model then run as one matrix multiplication instead of one per request
+        self.executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self.slots = None
+        self.worker = None
+        self.batch_size = histogram("batch_size", "Amount of images predicted in one batch",
+                                    [1, 2, 4, 8, 16, 32, 64, 128])
+        self.queue_wait = histogram("batch_queue_wait_seconds", "Time an image waited in the queue before its batch was predicted",
+                                    [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1])
+        self.batch_duration = histogram("batch_duration_seconds", "Time the model took to predict one batch", DURATION_BUCKETS)
+
+
+    def start(self):
+        # starts collecting batches, this has to be called from the event loop (see the startup event in main.py)
+        self.queue = asyncio.Queue()
+        # only as many batches as the executor can predict at the same time are sent to it
+        self.slots = asyncio.Semaphore(self.executor.concurrency)
+        self.worker = asyncio.get_event_loop().create_task(self.collect())
+
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+
+
+    async def predict(self, images, version=DEFAULT_VERSION):
+        # Puts the images (shape (n, 400, 400)) in the queue and waits until the batch they ended up in is predicted
+        # by the version of the model
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((images, future, time.perf_counter(), version))
+        return await future
+
+
+    async def collect(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            size = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            # keep adding requests until the batch is full or the oldest request waited long enough
+            while size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+                size += len(batch[-1][0])
+            # while the batch is predicted the next one is already being collected
+            await self.slots.acquire()
+            loop.create_task(self.run_batch(batch))
+
+
+    async def run_batch(self, batch):
+        try:
+            # the images of every version are predicted as one batch by that version, at the same time
+            versions = {}
+            for request in batch:
+                versions.setdefault(request[3], []).append(request)
+            await asyncio.gather(*[self.run_version(version, requests) for version, requests in versions.items()])
+        finally:
+            self.slots.release()
+
+
+    async def run_version(self, version, batch):
+        started = time.perf_counter()
+        for _, _, queued, _ in batch:
+            self.queue_wait.observe(started - queued)
+        images = np.concatenate([images for images, _, _, _ in batch])
+        self.batch_size.observe(len(images))
+        try:
+            # the prediction itself runs in the executor, so the api keeps accepting requests
+            predictions = await self.executor.run(infer, images, version)
+            self.batch_duration.observe(time.perf_counter() - started)
+        except Exception as e:
+            for _, future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        # give every request its own part of the batch back
+        start = 0
+        for images, future, _, _ in batch:
+            if not future.done():
+                future.set_result(predictions[start:start + len(images)])
+            start += len(images)
+
+
+# One scheduler per gunicorn worker, it gets started on startup (see main.py)
+scheduler = Batch_scheduler(executor)
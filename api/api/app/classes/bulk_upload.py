@@ -0,0 +1,148 @@
+import os
+import zlib
+import zipfile
+import tarfile
+
+import settings
+
+
+class Bulk_upload_error(Exception):
+    pass
+
+
+class Image_too_large(Bulk_upload_error):
+    pass
+
+
+class Unreadable_archive(Bulk_upload_error):
+    pass
+
+
+class Bulk_upload:
+
+    def __init__(self, uploads, max_image_bytes=settings.MAX_UPLOAD_BYTES):
+        # The uploaded files can be images, zip archives or (compressed) tar archives - the archives are read
+        # member by member from the spooled upload, so a large study is never completely loaded in memory.
+        # An image above the maximum size of one upload isn't read, a small archive can hold a member of gigabytes
+        self.uploads = uploads
+        self.max_image_bytes = max_image_bytes
+
+
+    def __iter__(self):
+        # yields the name and the bytes of every image, or a Bulk_upload_error instead of the bytes - a broken archive
+        # gives an error for the archive (or for the member that couldn't be read) and the next uploads are still read
+        for upload in self.uploads:
+            upload.file.seek(0)
+            kind = self.archive_kind(upload.file)
+            if kind == "zip":
+                yield from self.read_zip(upload.file, upload.filename)
+            elif kind == "tar":
+                yield from self.read_tar(upload.file, upload.filename)
+            else:
+                upload.file.seek(0, 2)
+                size = upload.file.tell()
+                upload.file.seek(0)
+                yield upload.filename, self.read_image(size, upload.file.read)
+
+
+    def chunks(self, size):
+        # yields lists of at most size images
+        chunk = []
+        for image in self:
+            chunk.append(image)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+    @staticmethod
+    def archive_kind(file):
+        # Looks at the first bytes instead of the file name, tar archives have "ustar" at byte 257
+        header = file.read(262)
+        file.seek(0)
+        if header.startswith(b"PK\x03\x04"):
+            return "zip"
+        if header.startswith(b"\x1f\x8b") or header[257:262] == b"ustar":
+            return "tar"
+        return None
+
+
+    def read_image(self, size, read):
+        # the size is checked before the image is read
+        if size > self.max_image_bytes:
+            return Image_too_large(f"The image of {size} bytes is larger than the maximum of {self.max_image_bytes} bytes")
+        return read()
+
+
+    def read_zip(self, file, name):
+        # zipfile never decompresses more than the file size of a member, a member that lies about its size fails its crc check
+        try:
+            archive = zipfile.ZipFile(file)
+        except (zipfile.BadZipFile, OSError) as e:
+            yield name, Unreadable_archive(f"Could not read the zip archive: {e}")
+            return
+        with archive:
+            for member in archive.infolist():
+                if member.is_dir():
+                    continue
+                try:
+                    yield member.filename, self.read_image(member.file_size, lambda: archive.read(member))
+                except (zipfile.BadZipFile, zlib.error, OSError, NotImplementedError) as e:
+                    # a corrupt member, the members after it have their own offset in the central directory
+                    yield member.filename, Unreadable_archive(f"Could not read the member of the zip archive: {e}")
+
+
+    def read_tar(self, file, name):
+        # stream mode reads the members in order without seeking back, a member that isn't read is skipped.
+        # A stream can't go past a corrupt part, the members before it are kept and the archive gets an error
+        try:
+            with tarfile.open(fileobj=file, mode="r|*") as archive:
+                for member in archive:
+                    if member.isfile():
+                        data = self.read_image(member.size, lambda: archive.extractfile(member).read())
+                        yield member.name, data
+        except (tarfile.TarError, zlib.error, EOFError, OSError) as e:
+            yield name, Unreadable_archive(f"Could not read the tar archive: {e}")
+
+
+class Zip_stream:
+
+    # The extensions of the encoded segmentations in the zip archive
+    EXTENSIONS = {"png": "png", "jpeg": "jpg", "raw": "raw", "rle": "rle.json", "bits": "bits", "polygons": "polygons.json"}
+
+    def __init__(self):
+        # A zip archive that is written in pieces: every added file can be sent to the user immediately,
+        # zipfile writes data descriptors because the stream can't seek back
+        self.buffer = []
+        self.archive = zipfile.ZipFile(self, mode="w", compression=zipfile.ZIP_STORED)
+
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        return len(data)
+
+
+    def flush(self):
+        pass
+
+
+    def add(self, name, content, image_format=None):
+        # the encoded images are already compressed, so they are stored as they are
+        if image_format is not None:
+            name = f"{os.path.splitext(name)[0]}.{self.EXTENSIONS[image_format]}"
+        self.archive.writestr(name, content)
+        return self.read()
+
+
+    def close(self):
+        # writes the central directory at the end of the archive
+        self.archive.close()
+        return self.read()
+
+
+    def read(self):
+        data = b"".join(self.buffer)
+        self.buffer = []
+        return data
@@ -0,0 +1,165 @@
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import settings
+from classes.pipeline import load_model, reload_model
+from classes.model_registry import registry
+from classes.metrics import gauge, counter
+
+
+class Executor_saturated(Exception):
+    pass
+
+
+class Inference_executor:
+
+    def __init__(self, kind=settings.EXECUTOR_KIND, workers=settings.EXECUTOR_WORKERS, max_pending=settings.EXECUTOR_MAX_PENDING):
+        # The executor runs the cpu bound stages of a prediction outside of the event loop,
+        # so one slow request doesn't block every other connection of the worker
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown executor kind {kind}, use thread or process")
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.pool = None
+        self.model_version = None
+        self.model_file_stat = None
+        self.reload_lock = None
+        self.ready = False
+        self.load_time = gauge("model_load_seconds", "Time it took to load and warm up the model in every worker of the executor")
+
+
+    def start(self):
+        if self.kind == "process":
+            # every process loads its own model once when it starts
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=load_model)
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+        self.reload_lock = asyncio.Lock()
+
+
+    def shutdown(self):
+        if self.pool is not None:
+            # the processes of a process pool are waited for, otherwise they outlive the worker that started them
+            self.pool.shutdown(wait=self.kind == "process")
+            self.pool = None
+        self.model_version = None
+        self.model_file_stat = None
+        self.reload_lock = None
+        self.ready = False
+
+
+    async def load(self):
+        # Loads the model in the pool, the executor is ready when every worker answered
+        # in a thread pool all threads share the registry of this process, so it is only loaded once
+        started = time.perf_counter()
+        self.model_file_stat = registry.file_stat()
+        try:
+            versions = await asyncio.gather(*[self.run(load_model) for _ in range(self.workers)])
+        except Exception:
+            if self.kind == "process":
+                # a process that failed to load the model breaks the whole pool, the next attempt starts new processes
+                self.pool.shutdown(wait=False)
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=load_model)
+            raise
+        self.load_time.set(time.perf_counter() - started)
+        self.model_version = versions[0]
+        self.ready = True
+
+
+    def model_file_stat_now(self):
+        try:
+            return registry.file_stat()
+        except OSError:
+            return None
+
+
+    def model_changed(self):
+        # True when the model file isn't the file that was loaded anymore (its modification time or size changed),
+        # a missing file is being replaced
+        file_stat = self.model_file_stat_now()
+        return self.model_file_stat is not None and file_stat is not None and file_stat != self.model_file_stat
+
+
+    async def reload(self):
+        # Loads the model file again and swaps it in when it is a new model, returns True when the model changed.
+        # The new model is loaded and warmed up next to the old one, so requests keep being answered by the old model until
+        # the swap and the requests that already started finish on it. A model that can't be loaded raises, the old model stays
+        async with self.reload_lock:
+            started = time.perf_counter()
+            file_stat = registry.file_stat()
+            try:
+                if self.kind == "process":
+                    changed, version = await self.reload_processes()
+                else:
+                    # the threads share the registry of this process, it swaps its pool of sessions
+                    changed, version = await self.run(reload_model)
+            except Exception:
+                counter("model_reloads_total", "Attempts to load a new model file", labels={"result": "failed"}).inc()
+                raise
+            self.model_file_stat = file_stat
+            if changed:
+                counter("model_reloads_total", "Attempts to load a new model file", labels={"result": "swapped"}).inc()
+                self.load_time.set(time.perf_counter() - started)
+                self.model_version = version
+            else:
+                counter("model_reloads_total", "Attempts to load a new model file", labels={"result": "unchanged"}).inc()
+            return changed
+
+
+    async def reload_processes(self):
+        # every process has its own registry, so a new pool of processes loads the new model while the old pool keeps
+        # predicting. Once every new process is loaded the pools are swapped and the old pool stops after its last task
+        loop = asyncio.get_event_loop()
+        pool = ProcessPoolExecutor(max_workers=self.workers, initializer=load_model)
+        try:
+            versions = await asyncio.gather(*[loop.run_in_executor(pool, load_model) for _ in range(self.workers)])
+        except Exception:
+            await loop.run_in_executor(None, pool.shutdown)
+            raise
+        if versions[0] == self.model_version:
+            await loop.run_in_executor(None, pool.shutdown)
+            return False, versions[0]
+        old_pool, self.pool = self.pool, pool
+        # waits in a thread of the event loop until the old processes finished their tasks and stopped
+        loop.run_in_executor(None, old_pool.shutdown)
+        return True, versions[0]
+
+
+    @property
+    def concurrency(self):
+        # the amount of batches that can be predicted at the same time
+        return self.workers if self.kind == "process" else min(self.workers, registry.pool_size)
+
+
+    def acquire(self):
+        # Counts the requests that are being handled, a request above the maximum is refused immediately
+        # instead of waiting in an ever growing queue (the event loop is single threaded, so no lock is needed)
+        if self.pending >= self.max_pending:
+            raise Executor_saturated(f"{self.pending} requests are already being handled")
+        self.pending += 1
+
+
+    def release(self):
+        self.pending -= 1
+
+
+    @asynccontextmanager
+    async def admit(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+    async def run(self, function, *args):
+        # runs one stage in the pool and waits for its result without blocking the event loop
+        return await asyncio.get_event_loop().run_in_executor(self.pool, function, *args)
+
+
+# One executor per gunicorn worker, it gets started on startup (see main.py)
+executor = Inference_executor()
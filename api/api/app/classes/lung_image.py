@@ -1,29 +1,89 @@
+import time
+
 import cv2
 import numpy as np
-from PIL import Image
-from io import BytesIO
 
 
 class Lung_image():
 
-    def __init__(self, uploaded_image):
-        # this class will take the input image, turn it to a npumpy array and resize it zo it is the right shape for the auto encoder model.
+    # the width and height the autoencoder model expects
+    SIZE = 400
+    JPEG_SIGNATURE = b"\xff\xd8"
+
+    def __init__(self, uploaded_image, out=None):
+        # this class will take the input image, decode it to a grayscale uint8 numpy array and resize it so it is the right shape for the auto encoder model.
+        # out can be a preallocated float32 (400, 400) array - like one image of a batch - the normalized image is written into it without extra copies
+        self.timings = {}
         self.image_to_np_array(uploaded_image)
         self.image_resize()
+        self.normalize(out)
+
+
+    def image_to_np_array(self, uploaded_image):
+        # Decodes the image the same way read_images in train.py does: opencv reads the image as BGR and it is converted to grayscale,
+        # a grayscale image is used as it is and 16 bit images are scaled to 8 bit like cv2.imread does.
+        # A jpeg is stored as luma and colour, libjpeg decodes only the luma (the same gray as the conversion) - that halves
+        # the decode time of large colour x-rays
+        start = time.perf_counter()
+        if len(uploaded_image) == 0:
+            raise ValueError("The uploaded file is empty")
+        flags = cv2.IMREAD_GRAYSCALE if bytes(uploaded_image[:2]) == self.JPEG_SIGNATURE else cv2.IMREAD_UNCHANGED
+        image = cv2.imdecode(np.frombuffer(uploaded_image, dtype=np.uint8), flags)
+        if image is None:
+            image = self.decode_with_pillow(uploaded_image)
+        if image.dtype != np.uint8:
+            image = (image >> 8).astype(np.uint8) if image.dtype == np.uint16 else cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+        if image.ndim == 3 and image.shape[2] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+        elif image.ndim == 3 and image.shape[2] == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        elif image.ndim == 3:
+            image = image[:, :, 0]
+        self.image = image
+        # the height and width of the upload, the mask can be resized back to it
+        self.original_shape = image.shape
+        self.timings["decode"] = time.perf_counter() - start
+
+
+    def decode_with_pillow(self, uploaded_image):
+        # Some formats opencv can't read (like gif) are decoded with pillow, it is only imported when it is needed
+        from io import BytesIO
+        from PIL import Image, UnidentifiedImageError
+        try:
+            return np.array(Image.open(BytesIO(uploaded_image)).convert("L"))
+        except UnidentifiedImageError:
+            raise ValueError("The uploaded file is not an image")
 
 
     def image_resize(self):
-        # reshape the image to a 400x400 image
-        self.image = cv2.resize(self.image, (400, 400))
-        # resize the image to have 3 dimensions instead of 2 - otherwise the model won't work
-        self.image = self.image.reshape(-1, 400, 400)
+        # reshape the image to a 400x400 image - resizing the uint8 image is faster than resizing the normalized float image,
+        # an image that is already 400x400 isn't resized. Large images are resized linearly like read_images in train.py does,
+        # smoothing them first (pyramid or area interpolation) is slower and gives the model other input than it was trained on
+        start = time.perf_counter()
+        if self.image.shape != (self.SIZE, self.SIZE):
+            self.image = cv2.resize(self.image, (self.SIZE, self.SIZE))
+        self.timings["resize"] = time.perf_counter() - start
 
 
-    def image_to_np_array(self, uploaded_image):
-        self.image = np.array(Image.open(BytesIO(uploaded_image))) / 255
+    def normalize(self, out=None):
+        # divide the pixels by 255 into a float32 array, the image gets 3 dimensions instead of 2 - otherwise the model won't work
+        start = time.perf_counter()
+        if out is None:
+            out = np.empty((self.SIZE, self.SIZE), dtype=np.float32)
+        np.divide(self.image, 255, out=out, dtype=np.float32)
+        self.image = out.reshape(-1, self.SIZE, self.SIZE)
+        self.timings["normalize"] = time.perf_counter() - start
 
 
     def get_image(self):
         # return the image
         return self.image
 
+
+    def get_timings(self):
+        # the seconds every stage of the preprocessing took
+        return self.timings
+
+
+    def get_original_shape(self):
+        return self.original_shape
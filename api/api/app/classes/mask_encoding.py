@@ -0,0 +1,73 @@
+import cv2
+import numpy as np
+
+
+# Compact encodings of a binary mask (a 2d bool array), for callers that only need the lung region instead of an image
+
+
+def rle_counts(mask):
+    # The run lengths of the mask in column-major order, starting with a run of background pixels like COCO does
+    # (a mask that starts with a lung pixel starts with a run of 0)
+    pixels = mask.ravel(order="F")
+    if pixels.size == 0:
+        return []
+    changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [pixels.size])))
+    if pixels[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.tolist()
+
+
+def rle_string(counts):
+    # The compressed counts string of the COCO api (pycocotools.mask.encode): every count is stored as the difference
+    # with the count two runs earlier, in groups of 5 bits with a continuation bit, as characters from 48 on.
+    # All counts are encoded at once, one group of 5 bits per step
+    values = np.array(counts, dtype=np.int64)
+    values[3:] -= np.array(counts[1:-2], dtype=np.int64)
+    characters, written = [], []
+    more = np.ones(len(values), dtype=bool)
+    while more.any():
+        character = values & 0x1f
+        values = values >> 5
+        # a negative difference ends when the rest is all ones, a positive difference when it is all zeros
+        continues = np.where(character & 0x10, values != -1, values != 0)
+        characters.append(np.where(continues, character | 0x20, character) + 48)
+        written.append(more)
+        more = more & continues
+    if not characters:
+        return ""
+    # the groups of every count in order, the groups after the last group of a count are dropped
+    return np.stack(characters, axis=1)[np.stack(written, axis=1)].astype(np.uint8).tobytes().decode("ascii")
+
+
+def rle(mask):
+    # COCO RLE, pycocotools.mask.decode reads it as it is
+    return {"size": list(mask.shape), "counts": rle_string(rle_counts(mask))}
+
+
+def bits(mask):
+    # 8 pixels per byte row by row, the most significant bit first (numpy.unpackbits reads it back)
+    return np.packbits(mask, axis=None).tobytes()
+
+
+def polygons(mask, epsilon=1.0, size=None):
+    # The outer contour of every lung as a polygon of [x, y] points, with its area and bounding box [x, y, width, height] in pixels,
+    # the largest lung first. The contours are simplified with the Douglas-Peucker algorithm, points may move up to epsilon pixels.
+    # With a size (height, width) the points are scaled from the mask to that size, instead of finding the contours in a resized mask
+    contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    scale = None if size is None or tuple(size) == mask.shape else np.array([size[1] / mask.shape[1], size[0] / mask.shape[0]])
+    lungs = []
+    for contour in contours:
+        if epsilon > 0:
+            contour = cv2.approxPolyDP(contour, epsilon, True)
+        # single pixels and lines of noise don't enclose an area
+        if len(contour) < 3:
+            continue
+        if scale is not None:
+            # the centers of the pixels are scaled, so a polygon stays centered on the same part of the image
+            contour = np.rint((contour + 0.5) * scale - 0.5).astype(np.int32)
+        x, y, width, height = cv2.boundingRect(contour)
+        lungs.append({"polygon": contour.reshape(-1, 2).tolist(), "area": float(cv2.contourArea(contour)),
+                      "bbox": [x, y, width, height]})
+    lungs.sort(key=lambda lung: lung["area"], reverse=True)
+    return {"size": list(size if scale is not None else mask.shape), "lungs": lungs}
@@ -0,0 +1,141 @@
+import bisect
+import threading
+
+
+class Histogram:
+
+    type = "histogram"
+
+    def __init__(self, name, description, buckets, labels=None):
+        # A cumulative histogram like prometheus uses them: every bucket counts the observations smaller or equal to its upper bound
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+
+    def snapshot(self):
+        # returns the cumulative count per upper bound, the last bucket (+Inf) equals the total count
+        with self.lock:
+            cumulative, buckets = 0, {}
+            for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            return {"description": self.description, "buckets": buckets, "count": self.count, "sum": self.sum}
+
+
+    def render(self):
+        # the prometheus text lines of this histogram
+        snapshot = self.snapshot()
+        lines = [f"{self.name}_bucket{format_labels(self.labels, le=bound)} {count}" for bound, count in snapshot["buckets"].items()]
+        lines.append(f"{self.name}_sum{format_labels(self.labels)} {snapshot['sum']}")
+        lines.append(f"{self.name}_count{format_labels(self.labels)} {snapshot['count']}")
+        return lines
+
+
+class Counter:
+
+    type = "counter"
+
+    def __init__(self, name, description, labels=None):
+        # A value that only goes up, like the amount of requests
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+        self.value = 0
+        self.lock = threading.Lock()
+
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+    def snapshot(self):
+        return {"description": self.description, "value": self.value}
+
+
+    def render(self):
+        return [f"{self.name}{format_labels(self.labels)} {self.value}"]
+
+
+class Gauge(Counter):
+
+    # A value that can go up and down, like the amount of bytes in a cache
+
+    type = "gauge"
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+# All metrics of this worker by name and labels, so every class can register its own metrics
+metrics = {}
+lock = threading.Lock()
+
+# Buckets for durations in seconds and for sizes in bytes
+DURATION_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [1024 * 4 ** power for power in range(10)]
+
+
+def format_labels(labels, **extra):
+    # {"stage": "decode"} -> {stage="decode"}
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def register(metric_class, name, *args, labels=None):
+    # returns the metric with this name and labels, it is created the first time
+    key = name + format_labels(labels or {})
+    with lock:
+        if key not in metrics:
+            metrics[key] = metric_class(name, *args, labels=labels)
+        return metrics[key]
+
+
+def histogram(name, description, buckets, labels=None):
+    return register(Histogram, name, description, buckets, labels=labels)
+
+
+def counter(name, description, labels=None):
+    return register(Counter, name, description, labels=labels)
+
+
+def gauge(name, description, labels=None):
+    return register(Gauge, name, description, labels=labels)
+
+
+def snapshot():
+    return {name: metric.snapshot() for name, metric in list(metrics.items())}
+
+
+def render():
+    # All metrics in the prometheus text format, the metrics with the same name (and other labels) are grouped together
+    groups = {}
+    for metric in list(metrics.values()):
+        groups.setdefault(metric.name, []).append(metric)
+    lines = []
+    for name, group in groups.items():
+        lines.append(f"# HELP {name} {group[0].description}")
+        lines.append(f"# TYPE {name} {group[0].type}")
+        for metric in group:
+            lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
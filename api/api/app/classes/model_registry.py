@@ -0,0 +1,219 @@
+import os
+import time
+import shutil
+import hashlib
+import weakref
+import threading
+from queue import Queue
+from contextlib import contextmanager
+
+import numpy as np
+import onnxruntime as runtime
+
+import settings
+
+
+class Loaded_model:
+
+    def __init__(self, sessions, version):
+        # One version of the model: its pool of sessions and everything that is looked up once per model.
+        # The registry swaps the whole object at once, so a prediction never mixes two versions
+        self.sessions = sessions
+        self.version = version
+        session = sessions.queue[0]
+        # the input and output names are the same for every session, so they are only looked up once
+        self.input_name = session.get_inputs()[0].name
+        self.output_name = session.get_outputs()[0].name
+        self.input_shape = session.get_inputs()[0].shape
+
+
+    @contextmanager
+    def session(self):
+        # Borrows a session from the pool of this version and gives it back to the same pool when the prediction is done,
+        # waits when all sessions of the pool are in use
+        session = self.sessions.get()
+        try:
+            yield session
+        finally:
+            self.sessions.put(session)
+
+
+    def warm_up(self):
+        # Runs one prediction on an empty image with every session, so the first real request doesn't pay for the lazy initialisation.
+        # It also validates the model: the mask must have the shape of the image
+        # dynamic dimensions (like the batch size) are strings or None in the onnx input shape
+        shape = [dim if isinstance(dim, int) else 1 for dim in self.input_shape]
+        for session in list(self.sessions.queue):
+            prediction = session.run([self.output_name], {self.input_name: np.zeros(shape, dtype=np.float32)})[0]
+            if list(prediction.shape) != shape:
+                raise ValueError(f"The model returns a prediction of shape {list(prediction.shape)} for an input of shape {shape}")
+
+
+class Model_registry:
+
+    # every registry of this process, to know which copies in the shared directory are still used
+    registries = weakref.WeakSet()
+    # a copy that was used less than this long ago is kept, another worker may be creating its sessions from it
+    SHARED_MODEL_GRACE_SECONDS = 60
+
+    def __init__(self, model_path=settings.MODEL_PATH, pool_size=settings.MODEL_POOL_SIZE,
+                 intra_op_threads=settings.MODEL_INTRA_OP_THREADS, inter_op_threads=settings.MODEL_INTER_OP_THREADS,
+                 shared_weights=settings.MODEL_SHARED_WEIGHTS, shared_directory=settings.MODEL_SHARED_DIRECTORY):
+        # The registry loads the onnx model once per worker and keeps a bounded pool of sessions,
+        # so a request only has to borrow a session instead of parsing and optimizing the model again
+        self.model_path = model_path
+        self.pool_size = max(1, pool_size)
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.shared_weights = shared_weights
+        self.shared_directory = shared_directory
+        self.model = None
+        self.ready = False
+        self.lock = threading.Lock()
+        Model_registry.registries.add(self)
+
+
+    @property
+    def version(self):
+        return self.model.version if self.model is not None else None
+
+
+    def load(self):
+        # Loads all the sessions of the pool, calling it again when the model is already loaded does nothing
+        with self.lock:
+            if self.ready:
+                return
+            self.model = self.load_model()
+            self.ready = True
+
+
+    def reload(self):
+        # Loads the model file into a new pool of sessions next to the pool that is in use and swaps them once the new
+        # model is warmed up. Requests that already borrowed a session finish on the old model, which is freed after them.
+        # When the new model can't be loaded or validated the old model stays in use and the error is raised
+        with self.lock:
+            if self.model is not None and self.hash_model() == self.model.version:
+                # the same model file was written again, keep the warm sessions
+                return False
+            self.model = self.load_model()
+            self.ready = True
+        if self.shared_weights:
+            self.remove_unused_shared_models()
+        return True
+
+
+    def load_model(self, attempts=3):
+        # The sessions are created from the model file instead of from its bytes: a session made from bytes keeps them,
+        # a second copy of the weights in every worker. The version has to be the hash of the file the sessions were made from,
+        # so when the file was replaced while the sessions were created (a new download) they are created again
+        for _ in range(attempts):
+            file_stat = self.file_stat()
+            version = self.hash_model()
+            session_path = self.shared_model(version, file_stat) if self.shared_weights else self.model_path
+            sessions = Queue(maxsize=self.pool_size)
+            for _ in range(self.pool_size):
+                sessions.put(self.create_session(session_path))
+            if self.file_stat() == file_stat:
+                break
+        else:
+            raise RuntimeError(f"The model file {self.model_path} kept changing while it was loaded")
+        model = Loaded_model(sessions, version)
+        model.warm_up()
+        return model
+
+
+    def create_session(self, session_path):
+        # Creates one inference session with the configured thread counts
+        options = runtime.SessionOptions()
+        options.intra_op_num_threads = self.intra_op_threads
+        options.inter_op_num_threads = self.inter_op_threads
+        if self.shared_weights:
+            # prepacking copies every weight into a private layout of the session, without it the matmuls read the mapped file
+            options.add_session_config_entry("session.disable_prepacking", "1")
+        return runtime.InferenceSession(session_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+    def shared_model(self, version, file_stat):
+        # The model with its weights in an external data file, written once per version in the shared directory. Onnxruntime maps
+        # an external data file into memory instead of reading it, so the sessions of every worker (and of every process of a process
+        # executor) read the same pages of the page cache instead of each holding their own copy of the weights.
+        # The first worker that loads a version writes it in a folder of its own and renames the folder, so the other workers
+        # never see half a model. When another worker was first its copy is used
+        shared_path = os.path.join(self.shared_directory, version, "model.onnx")
+        if os.path.exists(shared_path):
+            # marks the copy as used, so another worker doesn't remove it while the sessions are created
+            os.utime(os.path.dirname(shared_path))
+            return shared_path
+        temporary_directory = os.path.join(self.shared_directory, f"{version}.tmp-{os.getpid()}-{threading.get_ident()}")
+        os.makedirs(temporary_directory, exist_ok=True)
+        try:
+            options = runtime.SessionOptions()
+            # only the optimizations that are the same on every machine, the sessions apply the rest when they load it
+            options.graph_optimization_level = runtime.GraphOptimizationLevel.ORT_ENABLE_BASIC
+            options.optimized_model_filepath = os.path.join(temporary_directory, "model.onnx")
+            # every weight of a kilobyte or more goes to the data file, onnxruntime aligns them on pages so they can be mapped
+            options.add_session_config_entry("session.optimized_model_external_initializers_file_name", "model.onnx.data")
+            options.add_session_config_entry("session.optimized_model_external_initializers_min_size_in_bytes", "1024")
+            runtime.InferenceSession(self.model_path, sess_options=options, providers=["CPUExecutionProvider"])
+            if self.file_stat() != file_stat:
+                # the model file was replaced while it was written, load_model tries again with the new file
+                return self.model_path
+            os.replace(temporary_directory, os.path.dirname(shared_path))
+        except OSError:
+            # another worker renamed its folder first
+            if not os.path.exists(shared_path):
+                raise
+        finally:
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+        return shared_path
+
+
+    def remove_unused_shared_models(self):
+        # Removes the copies in the shared directory that no registry of this worker uses anymore (after a new model was
+        # swapped in or a version was unloaded), otherwise every model update leaves a copy of the weights behind.
+        # Another worker that still predicts with a removed copy keeps its mapping of the file, its space is freed after it.
+        # Copies that were used recently and folders that are still being written are kept
+        in_use = {registry.version for registry in list(Model_registry.registries)}
+        used_after = time.time() - self.SHARED_MODEL_GRACE_SECONDS
+        try:
+            names = os.listdir(self.shared_directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.shared_directory, name)
+            try:
+                if name in in_use or os.stat(path).st_mtime > used_after:
+                    continue
+            except OSError:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+
+
+    def hash_model(self):
+        # The version of the model is the hash of the model file, so a new model always gets a new version.
+        # The file is hashed in chunks, it is never in memory as a whole
+        digest = hashlib.blake2b(digest_size=16)
+        with open(self.model_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+    def file_stat(self):
+        # the file, modification time and size of the model file, a change means a new model was written
+        stat = os.stat(self.model_path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+    def predict(self, images):
+        # returns the prediction made with the lung images as input
+        if not self.ready:
+            raise RuntimeError("The model is not loaded yet")
+        # the model is read once, a reload during the prediction doesn't affect it
+        model = self.model
+        with model.session() as session:
+            return session.run([model.output_name], {model.input_name: images.astype(np.float32, copy=False)})[0]
+
+
+# One registry per gunicorn worker, it gets loaded on startup (see main.py)
+registry = Model_registry()
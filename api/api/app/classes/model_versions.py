@@ -0,0 +1,160 @@
+import os
+import re
+import random
+import logging
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
+import settings
+from classes.model_registry import Model_registry, registry
+from classes.metrics import counter, gauge
+
+
+# the dated copies of 04_DownloadModel.py: {day}_{month}_{year}_{model name}_{version}.onnx
+VERSION_FILE = re.compile(r"^(?P<date>\d{2}_\d{2}_\d{4})_(?P<name>.+)_(?P<version>[^_]+)\.onnx$")
+DEFAULT_VERSION = "default"
+
+
+class Unknown_model_version(LookupError):
+    pass
+
+
+class Model_version_failed(RuntimeError):
+    pass
+
+
+class Model_versions:
+
+    def __init__(self, directory=settings.MODEL_VERSIONS_DIRECTORY, max_bytes=settings.MODEL_VERSIONS_MAX_BYTES, default=registry):
+        # Serves other versions of the model next to the default model (MODEL_PATH). A version is loaded the first time it
+        # is asked for, and the least recently used versions are unloaded when the loaded versions don't fit in the byte budget.
+        # Every version has its own registry, so its sessions are pooled and warmed up like the default model
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.default = default
+        self.paths = {}
+        self.loaded = OrderedDict()
+        self.lock = threading.Lock()
+        self.loads = counter("model_version_loads_total", "Model versions that were loaded on first use")
+        self.unloads = counter("model_version_unloads_total", "Model versions that were unloaded to stay within the memory budget")
+        self.occupancy = gauge("model_versions_bytes", "Estimated memory of the loaded model versions (file size times pool size)")
+
+
+    def scan(self):
+        # the newest file of every version in the directory
+        paths, dates = {}, {}
+        if os.path.isdir(self.directory):
+            for file_name in os.listdir(self.directory):
+                match = VERSION_FILE.match(file_name)
+                if match is None:
+                    continue
+                date = datetime.strptime(match["date"], "%d_%m_%Y")
+                if match["version"] not in dates or date > dates[match["version"]]:
+                    paths[match["version"]] = os.path.join(self.directory, file_name)
+                    dates[match["version"]] = date
+        self.paths = paths
+        return paths
+
+
+    def exists(self, version):
+        # a version that isn't known yet may have been copied into the directory since the last scan
+        return version == DEFAULT_VERSION or version in self.paths or version in self.scan()
+
+
+    def get(self, version):
+        # Returns the loaded registry of the version, loads it first when it isn't loaded
+        if version == DEFAULT_VERSION:
+            return self.default
+        with self.lock:
+            model = self.loaded.get(version)
+            if model is not None:
+                self.loaded.move_to_end(version)
+            else:
+                if not self.exists(version):
+                    raise Unknown_model_version(version)
+                model = Model_registry(self.paths[version], self.default.pool_size,
+                                       self.default.intra_op_threads, self.default.inter_op_threads)
+                self.loaded[version] = model
+        # loaded outside of the lock, so the other versions keep predicting - the registry has its own lock.
+        # A version file that can't be loaded is a server error, not an error of the uploaded image
+        if not model.ready:
+            try:
+                model.load()
+            except Exception as e:
+                raise Model_version_failed(f"Model version {version} could not be loaded: {e}") from e
+            self.loads.inc()
+            self.evict(keep=version)
+        return model
+
+
+    def size(self, model):
+        # the weights dominate the memory of a session, every session of the pool has its own copy unless they share the mapped weights
+        return os.path.getsize(model.model_path) * (1 if model.shared_weights else model.pool_size)
+
+
+    def evict(self, keep):
+        # unloads the least recently used versions until the loaded versions fit in the budget - requests that are
+        # predicting with an unloaded version finish, its sessions are freed after them
+        unloaded = False
+        with self.lock:
+            sizes = {version: self.size(model) for version, model in self.loaded.items()}
+            for version in list(self.loaded):
+                if sum(sizes.values()) <= self.max_bytes:
+                    break
+                if version != keep:
+                    del self.loaded[version]
+                    del sizes[version]
+                    self.unloads.inc()
+                    unloaded = True
+            self.occupancy.set(sum(sizes.values()))
+        if unloaded and self.default.shared_weights:
+            self.default.remove_unused_shared_models()
+
+
+    def predict(self, version, images):
+        return self.get(version).predict(images)
+
+
+class Traffic_split:
+
+    def __init__(self, canary_version=settings.MODEL_CANARY_VERSION, canary_percent=settings.MODEL_CANARY_PERCENT,
+                 shadow_version=settings.MODEL_SHADOW_VERSION, shadow_percent=settings.MODEL_SHADOW_PERCENT):
+        # Decides which version answers a request without a version: the canary version answers a percentage of them.
+        # The shadow version also predicts a percentage of the requests in the background, its answer is only compared
+        self.canary_version = canary_version
+        self.canary_percent = canary_percent if canary_version else 0
+        self.shadow_version = shadow_version
+        self.shadow_percent = shadow_percent if shadow_version else 0
+
+
+    def check(self, versions):
+        # A canary or shadow version that isn't in the versions directory is disabled on startup, otherwise the requests
+        # without a version that are sent to it would get a 404
+        if self.canary_percent and not versions.exists(self.canary_version):
+            logging.warning(f"The canary version {self.canary_version} doesn't exist in {versions.directory}, the canary is disabled")
+            self.canary_percent = 0
+        if self.shadow_percent and not versions.exists(self.shadow_version):
+            logging.warning(f"The shadow version {self.shadow_version} doesn't exist in {versions.directory}, the shadow is disabled")
+            self.shadow_percent = 0
+
+
+    def route(self, requested):
+        # returns the version that answers the request and why
+        if requested:
+            return requested, "requested"
+        if self.canary_percent and random.random() * 100 < self.canary_percent:
+            return self.canary_version, "canary"
+        return DEFAULT_VERSION, "default"
+
+
+    def shadow(self, served):
+        # returns the version that predicts the request in the background, or None
+        if self.shadow_percent and served != self.shadow_version and random.random() * 100 < self.shadow_percent:
+            return self.shadow_version
+        return None
+
+
+# One set of versions per gunicorn worker (and per process of a process executor)
+model_versions = Model_versions()
+traffic_split = Traffic_split()
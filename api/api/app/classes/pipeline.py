@@ -0,0 +1,50 @@
+from classes.lung_image import Lung_image
+from classes.autoencoder import Autoencoder
+from classes.segmentation_image import Segmentation
+from classes.tensor import Tensor_input, Tensor_output
+from classes.model_registry import registry
+from classes.model_versions import DEFAULT_VERSION
+
+
+# The stages of a prediction, they are plain functions so the executor can run them in a thread or in a process
+
+
+def load_model():
+    # loads the model of the worker that runs this stage - in a process pool every process has its own registry
+    registry.load()
+    return registry.version
+
+
+def reload_model():
+    # loads a new model file next to the model in use, returns whether the model changed and the version in use
+    changed = registry.reload()
+    return changed, registry.version
+
+
+def preprocess(uploaded_image, out=None):
+    # decode the uploaded image and resize it to the input shape of the model, returns the image, the seconds every step took
+    # and the height and width of the uploaded image. In a thread pool out can be the image of a batch, it is written in place
+    lung_image = Lung_image(uploaded_image, out=out)
+    return lung_image.get_image(), lung_image.get_timings(), lung_image.get_original_shape()
+
+
+def infer(images, version=DEFAULT_VERSION):
+    return Autoencoder(version).predict(images)
+
+
+def encode(prediction, image_format, quality, threshold, size=None):
+    # encode the prediction in memory, returns the encoded bytes, their media type and the shape of the mask.
+    # The mask is resized to size (height, width) when it is given
+    segmentation = Segmentation(prediction, image_format, quality, threshold, size)
+    return segmentation.get_image(), segmentation.get_media_type(), segmentation.get_shape()
+
+
+def decode_tensor(body, dtype, shape):
+    # read a raw or .npy tensor of decoded 400x400 images, returns the (n, 400, 400) float32 input of the model
+    return Tensor_input(body, dtype, shape).get_image()
+
+
+def encode_tensor(prediction, output, container, threshold):
+    # returns the prediction as tensor bytes, their media type, the shape of the masks and the dtype of the pixels
+    tensor = Tensor_output(prediction, output, container, threshold)
+    return tensor.get_content(), tensor.get_media_type(), tensor.get_shape(), tensor.get_dtype()
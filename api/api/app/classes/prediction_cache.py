@@ -0,0 +1,52 @@
+import hashlib
+
+import settings
+from classes.result_store import Result_store
+
+
+class Prediction_cache:
+
+    def __init__(self, max_bytes=settings.PREDICTION_CACHE_MAX_BYTES, ttl_seconds=settings.PREDICTION_CACHE_TTL_SECONDS,
+                 tensor_key=settings.PREDICTION_CACHE_TENSOR_KEY):
+        # The cache is content addressed: the key is a hash of the uploaded bytes (or of the preprocessed image)
+        # together with the version of the model, so a new model never answers with the predictions of the old one
+        self.store = Result_store("prediction_cache", max_bytes, ttl_seconds)
+        self.enabled = max_bytes > 0
+        self.tensor_key_enabled = self.enabled and tensor_key
+        self.model_version = None
+
+
+    def set_model_version(self, model_version):
+        # the entries of another model version can never be hit again, so they are removed immediately
+        if model_version != self.model_version:
+            self.store.clear()
+            self.model_version = model_version
+
+
+    def upload_key(self, uploaded_image, *options):
+        # the key of the encoded segmentation, the output options (format, quality, ...) are part of the key
+        key = hashlib.blake2b(uploaded_image, digest_size=16)
+        key.update(repr((self.model_version,) + options).encode())
+        return f"upload-{key.hexdigest()}"
+
+
+    def tensor_key(self, image, *options):
+        # the key of the raw prediction of a preprocessed image, the model version that is asked for is one of the options
+        key = hashlib.blake2b(image.tobytes(), digest_size=16)
+        key.update(repr((self.model_version, image.shape, image.dtype.str) + options).encode())
+        return f"tensor-{key.hexdigest()}"
+
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        return self.store.get(key)
+
+
+    def put(self, key, value, size):
+        if self.enabled:
+            self.store.put(key, value, size)
+
+
+# One cache per gunicorn worker
+prediction_cache = Prediction_cache()
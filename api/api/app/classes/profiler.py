@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+
+class Sampling_profiler:
+
+    def __init__(self):
+        # A statistical profiler: a background thread looks at the stack of every other thread of this worker
+        # at a fixed interval, the stacks that show up most are where the time goes
+        self.thread = None
+        self.running = threading.Event()
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+
+
+    def start(self, interval_ms=5):
+        if self.thread is not None:
+            raise RuntimeError("The profiler is already running")
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = time.perf_counter()
+        self.running.set()
+        self.thread = threading.Thread(target=self.sample, args=(interval_ms / 1000,), name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        # Stops sampling and returns the stacks in the collapsed format ("outer;inner count" per line),
+        # flamegraph.pl and speedscope can turn it into a flame graph
+        if self.thread is None:
+            raise RuntimeError("The profiler isn't running")
+        self.running.clear()
+        self.thread.join()
+        self.thread = None
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+    def status(self):
+        return {"running": self.thread is not None, "pid": os.getpid(), "samples": self.samples,
+                "seconds": time.perf_counter() - self.started if self.thread is not None else 0}
+
+
+    def sample(self, interval):
+        own_thread = threading.get_ident()
+        names = {}
+        while self.running.is_set():
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread:
+                    self.stacks[self.collapse(names.get(thread_id, thread_id), frame)] += 1
+            self.samples += 1
+            time.sleep(interval)
+
+
+    @staticmethod
+    def collapse(thread_name, frame):
+        # the stack from the outer to the inner function, every function as file:function:line
+        functions = []
+        while frame is not None:
+            code = frame.f_code
+            functions.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        return ";".join([str(thread_name)] + functions[::-1])
+
+
+# One profiler per gunicorn worker, a request to /debug/profiler only reaches the worker that handles it
+profiler = Sampling_profiler()
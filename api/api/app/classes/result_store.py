@@ -0,0 +1,223 @@
+import os
+import time
+import uuid
+import pickle
+import threading
+from collections import OrderedDict
+
+import settings
+from classes.metrics import counter, gauge
+
+
+class Result_store:
+
+    # put and get only use memory, they can be called on the event loop
+    blocking = False
+
+    def __init__(self, name, max_bytes, ttl_seconds):
+        # An in memory store with a byte budget: entries expire after the ttl and the least recently used entries
+        # are evicted when the budget is full, so the memory of a worker can't grow without a limit
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = counter(f"{name}_hits_total", "Lookups that found their entry")
+        self.misses = counter(f"{name}_misses_total", "Lookups of an entry that doesn't exist or expired")
+        self.evictions = counter(f"{name}_evictions_total", "Entries removed because they expired or the byte budget was full")
+        self.occupancy = gauge(f"{name}_bytes", "Bytes used by the entries")
+        self.size = gauge(f"{name}_entries", "Amount of entries")
+
+
+    def put(self, key, value, size):
+        # Adds the value under the key, size is the amount of bytes the value uses
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, size, time.monotonic() + self.ttl_seconds)
+            self.bytes += size
+            self.evict_expired()
+            # the oldest entries are at the start of the ordered dict
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions.inc()
+            self.update_gauges()
+
+
+    def get(self, key):
+        # Returns the value or None, the values are never changed so they can be used after the lock is released
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[2] < time.monotonic():
+                if entry is not None:
+                    self.remove(key)
+                    self.evictions.inc()
+                    self.update_gauges()
+                self.misses.inc()
+                return None
+            self.entries.move_to_end(key)
+            self.hits.inc()
+            return entry[0]
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.update_gauges()
+
+
+    def evict_expired(self):
+        # Removes all expired entries, the caller has to hold the lock
+        now = time.monotonic()
+        for key in [key for key, (_, _, expires) in self.entries.items() if expires < now]:
+            self.remove(key)
+            self.evictions.inc()
+
+
+    def sweep(self):
+        # removes the expired entries of a store that isn't used for a while (see main.py)
+        with self.lock:
+            self.evict_expired()
+            self.update_gauges()
+
+
+    def remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+
+    def update_gauges(self):
+        self.occupancy.set(self.bytes)
+        self.size.set(len(self.entries))
+
+
+class Disk_result_store:
+
+    # a full store is evicted to this part of its budget, so the directory is scanned once per tenth of the budget instead of on every put
+    EVICT_TO = 0.9
+    # put and get pickle and read or write files, the api calls them in a thread
+    blocking = True
+
+    def __init__(self, name, directory, max_bytes, ttl_seconds):
+        # The same store on disk, it is shared by all gunicorn workers of a pod - every entry is one file
+        # and its modification time is used for the ttl and to find the oldest entries when the budget is full
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.hits = counter(f"{name}_hits_total", "Lookups that found their entry")
+        self.misses = counter(f"{name}_misses_total", "Lookups of an entry that doesn't exist or expired")
+        self.evictions = counter(f"{name}_evictions_total", "Entries removed because they expired or the byte budget was full")
+        self.occupancy = gauge(f"{name}_bytes", "Bytes used by the entries")
+        self.size = gauge(f"{name}_entries", "Amount of entries")
+        os.makedirs(self.directory, exist_ok=True)
+        # The bytes of the directory as far as this worker knows: the entries it wrote since its last sweep are added, the
+        # entries of the other workers are counted when it sweeps (every minute, see main.py, or when the budget looks full)
+        self.bytes = sum(size for _, _, size in self.list_entries())
+
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        path = self.path(key)
+        # write to a temporary file first and rename it, so a reader never sees a half written entry
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            pickle.dump(value, f)
+            written = f.tell()
+        os.replace(temporary, path)
+        # the directory is only scanned when the budget is full, the expired entries are removed by the sweep every minute
+        with self.lock:
+            self.bytes += written
+            full = self.bytes > self.max_bytes
+        if full:
+            self.sweep(self.max_bytes * self.EVICT_TO)
+
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            # an opened file can still be read when another worker removes it at the same time
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_mtime + self.ttl_seconds < time.time():
+                    raise FileNotFoundError(path)
+                value = pickle.load(f)
+        except FileNotFoundError:
+            self.misses.inc()
+            return None
+        self.hits.inc()
+        return value
+
+
+    def clear(self):
+        with self.lock:
+            for path, _, _ in self.list_entries():
+                self.unlink(path)
+            self.bytes = 0
+            self.update_gauges(0, 0)
+
+
+    def sweep(self, max_bytes=None):
+        # Removes the expired entries and the oldest ones until the store fits in its budget (or in max_bytes)
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self.lock:
+            expired = time.time() - self.ttl_seconds
+            entries = sorted(self.list_entries(), key=lambda entry: entry[1])
+            total = sum(size for _, _, size in entries)
+            removed = 0
+            for path, modified, size in entries:
+                if modified >= expired and total <= max_bytes:
+                    break
+                self.unlink(path)
+                self.evictions.inc()
+                total -= size
+                removed += 1
+            self.bytes = total
+            self.update_gauges(total, len(entries) - removed)
+
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.result")
+
+
+    def list_entries(self):
+        # returns the path, modification time and size of every entry, skipping the ones another worker just removed
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".result"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((entry.path, stat.st_mtime, stat.st_size))
+        return entries
+
+
+    def unlink(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+    def update_gauges(self, total, count):
+        self.occupancy.set(total)
+        self.size.set(count)
+
+
+def create_result_id():
+    return uuid.uuid4().hex
+
+
+# The memory store is per gunicorn worker - a result can only be downloaded from the worker that made it,
+# the disk store is shared by all workers of a pod
+if settings.RESULT_STORE_KIND == "disk":
+    result_store = Disk_result_store("result_store", settings.RESULT_STORE_DIRECTORY, settings.RESULT_STORE_MAX_BYTES, settings.RESULT_STORE_TTL_SECONDS)
+else:
+    result_store = Result_store("result_store", settings.RESULT_STORE_MAX_BYTES, settings.RESULT_STORE_TTL_SECONDS)
@@ -1,24 +1,97 @@
-import uuid
+import json
+
+import cv2
 import numpy as np
-import matplotlib.pyplot as plt
+
+import settings
+from classes import mask_encoding
+
 
 class Segmentation:
 
-    def __init__(self, image_to_save):
-        self.create_unique_name()
-        self.save_image(image_to_save)
-    
+    # the formats the segmentation can be encoded to and their media type
+    MEDIA_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "raw": "application/octet-stream",
+                   "rle": "application/json", "bits": "application/octet-stream", "polygons": "application/json"}
+    # the compact formats only describe the lungs, they always use a threshold
+    COMPACT_FORMATS = ("rle", "bits", "polygons")
+    # the mask has the 400x400 size of the model or the original size of the uploaded image
+    SIZES = ("model", "original")
+
+    def __init__(self, prediction, image_format=settings.OUTPUT_FORMAT, quality=settings.OUTPUT_QUALITY, threshold=settings.MASK_THRESHOLD, size=None):
+        # The prediction is encoded in memory, so nothing is written to or read from the disk.
+        # size is the (height, width) the mask is resized to, like the size of the uploaded image - the 400x400 mask when it is None
+        if image_format not in self.MEDIA_TYPES:
+            raise ValueError(f"Unknown image format {image_format}, use one of {', '.join(self.MEDIA_TYPES)}")
+        self.image_format = image_format
+        if image_format in self.COMPACT_FORMATS:
+            self.encode_compact(prediction, 0.5 if threshold is None else threshold, size)
+        else:
+            self.create_mask(prediction, threshold)
+            self.resize_mask(size, threshold is not None)
+            self.encode_image(quality)
+            self.shape = self.mask.shape
+
+
+    def create_mask(self, prediction, threshold):
+        # The model returns the probability (sigmoid) that a pixel belongs to the lungs, this turns it into a grayscale uint8 image
+        probabilities = np.squeeze(prediction)
+        if threshold is None:
+            self.mask = (probabilities * 255 + 0.5).clip(0, 255).astype(np.uint8)
+        else:
+            self.mask = (probabilities > threshold).astype(np.uint8) * 255
+
+
+    def resize_mask(self, size, binary):
+        # The uint8 mask is resized once instead of the float probabilities. A black and white mask is interpolated
+        # and thresholded again, so its edges stay smooth instead of becoming blocks of pixels
+        if size is None or tuple(size) == self.mask.shape:
+            return
+        self.mask = cv2.resize(self.mask, (size[1], size[0]), interpolation=cv2.INTER_LINEAR)
+        if binary:
+            self.mask = cv2.threshold(self.mask, 127, 255, cv2.THRESH_BINARY)[1]
+
+
+    def encode_image(self, quality):
+        # png is lossless, jpeg uses the quality (1 - 100) and raw returns the uint8 pixels row by row
+        if self.image_format == "raw":
+            self.image = self.mask.tobytes()
+            return
+        if self.image_format == "png":
+            # png doesn't have a quality, a higher quality gives a faster but lower compression (0 - 9)
+            params = [cv2.IMWRITE_PNG_COMPRESSION, int(round((100 - quality) * 9 / 100))]
+        else:
+            params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        succeeded, buffer = cv2.imencode(f".{self.image_format}", self.mask, params)
+        if not succeeded:
+            raise ValueError(f"Could not encode the segmentation as {self.image_format}")
+        self.image = buffer.tobytes()
+
+
+    def encode_compact(self, prediction, threshold, size):
+        # rle and polygons are json, bits are the packed binary mask - no image is encoded.
+        # The polygons are found on the 400x400 mask and their points are scaled to the size, the other masks are resized
+        self.mask = np.squeeze(prediction) > threshold
+        self.shape = tuple(size) if size is not None else self.mask.shape
+        if self.image_format == "polygons":
+            self.image = json.dumps(mask_encoding.polygons(self.mask, settings.POLYGON_EPSILON, size), separators=(",", ":")).encode()
+            return
+        if self.shape != self.mask.shape:
+            self.mask = self.mask.view(np.uint8) * np.uint8(255)
+            self.resize_mask(size, True)
+            self.mask = self.mask > 127
+        if self.image_format == "bits":
+            self.image = mask_encoding.bits(self.mask)
+        else:
+            self.image = json.dumps(mask_encoding.rle(self.mask), separators=(",", ":")).encode()
+
+
+    def get_image(self):
+        return self.image
+
 
-    def save_image(self, image_to_save):
-        # This will save the image with the unique name to the correct directory, so it can be sent back to the user
-        plt.imshow(np.squeeze(image_to_save), cmap="gray")
-        plt.savefig(f".//images//{self.get_image_name()}")
+    def get_media_type(self):
+        return self.MEDIA_TYPES[self.image_format]
 
-    
-    def create_unique_name(self):
-        # assignes an unique name to the image
-        self.name = f"{uuid.uuid1()}.jpg"
 
-    
-    def get_image_name(self):
-        return self.name
\ No newline at end of file
+    def get_shape(self):
+        return self.shape
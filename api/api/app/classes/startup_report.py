@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import logging
+
+from classes.metrics import gauge
+
+
+# the moment this module was imported, main.py imports it before anything else
+IMPORTED = time.perf_counter()
+
+
+def resident_memory():
+    # the resident memory (RSS) of this process in bytes, from /proc on linux - elsewhere the peak RSS is the closest there is
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    # macos reports bytes, the other systems kilobytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def process_age():
+    # The seconds since this process was started (linux), so the report includes the interpreter and the imports.
+    # Elsewhere it is the time since this module was imported
+    try:
+        with open("/proc/self/stat") as f:
+            # the process name can contain spaces, the fields after it are split
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - IMPORTED
+
+
+class Startup_report:
+
+    def __init__(self):
+        # Records how long after the start of the worker process every stage was done (imports, model, first_prediction)
+        # and the memory of the worker at that moment, they are logged, shown by /ready and exported as metrics
+        self.stages = {}
+        self.logger = logging.getLogger("uvicorn.error")
+
+
+    def record(self, stage):
+        # only the first time a stage is done counts
+        if stage in self.stages:
+            return
+        seconds, memory = process_age(), resident_memory()
+        self.stages[stage] = {"seconds": round(seconds, 3), "rss_bytes": memory}
+        gauge("worker_startup_seconds", "Seconds after the start of the worker process a startup stage was done", labels={"stage": stage}).set(seconds)
+        gauge("worker_startup_rss_bytes", "Resident memory of the worker when a startup stage was done", labels={"stage": stage}).set(memory)
+        self.logger.info(f"Worker {os.getpid()} {stage} done after {seconds:.2f} s, RSS {memory / 2 ** 20:.1f} MB")
+
+
+    def done(self, stage):
+        return stage in self.stages
+
+
+# One report per gunicorn worker
+startup_report = Startup_report()
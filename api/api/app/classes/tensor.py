@@ -0,0 +1,127 @@
+import io
+import math
+
+import numpy as np
+
+from classes.lung_image import Lung_image
+
+
+class Tensor_input:
+
+    # the dtypes a raw body can have, always little-endian
+    DTYPES = {"float32": np.dtype("<f4"), "uint8": np.dtype("u1")}
+    NPY_MAGIC = b"\x93NUMPY"
+
+    def __init__(self, body, dtype="float32", shape=None):
+        # This class takes images that are already decoded and resized (a 400x400 array or a batch of them) and turns them
+        # into the (n, 400, 400) float32 input of the model without any image codec: a raw body is read in place, a .npy body
+        # is recognised by its magic bytes. Float32 pixels are used as they are (0 - 1 like Lung_image), uint8 pixels are divided by 255
+        if len(body) == 0:
+            raise ValueError("The body is empty")
+        if bytes(body[:len(self.NPY_MAGIC)]) == self.NPY_MAGIC:
+            tensor = self.read_npy(body)
+        else:
+            tensor = self.read_raw(body, dtype, shape)
+        self.image = self.normalize(self.reshape(tensor))
+
+
+    def read_npy(self, body):
+        # pickled object arrays are refused, only plain numeric arrays are read
+        try:
+            tensor = np.load(io.BytesIO(body), allow_pickle=False)
+        except ValueError as e:
+            raise ValueError(f"The body is not a valid .npy array: {e}")
+        if tensor.dtype == np.uint8:
+            return tensor
+        if tensor.dtype.kind != "f":
+            raise ValueError(f"Unsupported .npy dtype {tensor.dtype}, use float32 or uint8")
+        return tensor.astype(np.float32, copy=False)
+
+
+    def read_raw(self, body, dtype, shape):
+        # the shape comes from the X-Tensor-Shape header, without it the body is a batch of 400x400 images
+        if dtype not in self.DTYPES:
+            raise ValueError(f"Unknown dtype {dtype}, use one of {', '.join(self.DTYPES)}")
+        dtype = self.DTYPES[dtype]
+        image_bytes = Lung_image.SIZE * Lung_image.SIZE * dtype.itemsize
+        if shape is None:
+            if len(body) % image_bytes:
+                raise ValueError(f"The body of {len(body)} bytes isn't a whole number of {Lung_image.SIZE}x{Lung_image.SIZE} {dtype.name} images")
+            shape = (len(body) // image_bytes, Lung_image.SIZE, Lung_image.SIZE)
+        if math.prod(shape) * dtype.itemsize != len(body):
+            raise ValueError(f"The body of {len(body)} bytes doesn't have the shape {','.join(map(str, shape))} of {dtype.name}")
+        # a view on the body, the bytes are not copied
+        return np.frombuffer(body, dtype=dtype).reshape(shape)
+
+
+    def reshape(self, tensor):
+        # one image (400, 400), a batch (n, 400, 400) or a batch with a channel (n, 1, 400, 400)
+        if tensor.ndim == 4 and tensor.shape[1] == 1:
+            tensor = tensor[:, 0]
+        elif tensor.ndim == 2:
+            tensor = tensor[np.newaxis]
+        if tensor.ndim != 3 or tensor.shape[1:] != (Lung_image.SIZE, Lung_image.SIZE) or len(tensor) == 0:
+            raise ValueError(f"The tensor has shape {tensor.shape}, the model expects {Lung_image.SIZE}x{Lung_image.SIZE} images")
+        return tensor
+
+
+    def normalize(self, tensor):
+        if tensor.dtype == np.uint8:
+            return np.divide(tensor, 255, dtype=np.float32)
+        # a big-endian or not contiguous array is copied once, a little-endian float32 body is used as it is
+        return np.ascontiguousarray(tensor, dtype=np.float32)
+
+
+    def get_image(self):
+        return self.image
+
+
+class Tensor_output:
+
+    # probabilities: the float32 probabilities, mask: one uint8 (0 or 1) per pixel, bits: 8 pixels per byte (np.packbits)
+    OUTPUTS = {"probabilities": "float32", "mask": "uint8", "bits": "bits"}
+    MEDIA_TYPES = {"raw": "application/octet-stream", "npy": "application/x-npy"}
+
+    def __init__(self, prediction, output="probabilities", container="raw", threshold=0.5):
+        # The prediction is returned as a tensor instead of an image, every image of the batch row by row (little-endian).
+        # The bits of an image are packed most significant bit first and every image starts on a new byte
+        if output not in self.OUTPUTS:
+            raise ValueError(f"Unknown output {output}, use one of {', '.join(self.OUTPUTS)}")
+        if container not in self.MEDIA_TYPES:
+            raise ValueError(f"Unknown container {container}, use one of {', '.join(self.MEDIA_TYPES)}")
+        self.output = output
+        self.container = container
+        # the shape of the masks, without the channel of the model
+        prediction = prediction.reshape(len(prediction), Lung_image.SIZE, Lung_image.SIZE)
+        self.shape = prediction.shape
+        if output == "probabilities":
+            tensor = prediction.astype("<f4", copy=False)
+        else:
+            tensor = (prediction > threshold).view(np.uint8)
+            if output == "bits":
+                tensor = np.packbits(tensor.reshape(len(tensor), -1), axis=1)
+        self.content = self.encode(tensor)
+
+
+    def encode(self, tensor):
+        if self.container == "raw":
+            return tensor.tobytes()
+        buffer = io.BytesIO()
+        np.save(buffer, tensor, allow_pickle=False)
+        return buffer.getvalue()
+
+
+    def get_content(self):
+        return self.content
+
+
+    def get_media_type(self):
+        return self.MEDIA_TYPES[self.container]
+
+
+    def get_shape(self):
+        return self.shape
+
+
+    def get_dtype(self):
+        return self.OUTPUTS[self.output]
@@ -0,0 +1,72 @@
+import json
+
+from classes.metrics import counter
+
+
+class Upload_too_large(Exception):
+    pass
+
+
+class Upload_limit:
+
+    def __init__(self, app, limits):
+        # An asgi middleware that refuses uploads above the maximum size of their route before they are read:
+        # a Content-Length above the limit is answered immediately with a 413, a body without a length (chunked)
+        # is counted while it is received and stopped as soon as it passes the limit.
+        # limits maps the path of a route to its maximum amount of bytes
+        self.app = app
+        self.limits = limits
+        self.rejected = counter("uploads_rejected_total", "Uploads refused because they are larger than the maximum upload size")
+
+
+    async def __call__(self, scope, receive, send):
+        max_bytes = self.limits.get(scope.get("path")) if scope["type"] == "http" and scope.get("method") == "POST" else None
+        if max_bytes is None:
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_bytes:
+            return await self.refuse(send, max_bytes)
+
+        received = 0
+        exceeded = False
+        answered = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    exceeded = True
+                    raise Upload_too_large()
+            return message
+
+        async def limited_send(message):
+            nonlocal answered
+            if exceeded:
+                # the app may answer the stopped upload with its own error (like a 400 for a body it couldn't parse),
+                # it is replaced by the 413
+                if not answered and message["type"] == "http.response.start":
+                    answered = True
+                    await self.refuse(send, max_bytes)
+                return
+            answered = answered or message["type"] == "http.response.start"
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, limited_send)
+        except Upload_too_large:
+            # nothing more can be sent when the response already started
+            if not answered:
+                answered = True
+                await self.refuse(send, max_bytes)
+
+
+    async def refuse(self, send, max_bytes):
+        self.rejected.inc()
+        body = json.dumps({"detail": f"The upload is larger than the maximum of {max_bytes} bytes"}).encode()
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), (b"connection", b"close")]})
+        await send({"type": "http.response.body", "body": body})
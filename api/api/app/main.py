@@ -1,11 +1,59 @@
-import os
-from fastapi import FastAPI
+# imported first, so the startup report also measures the imports below
+from classes.startup_report import startup_report
+import time
+import asyncio
+import logging
+from fastapi import FastAPI, Request, Response, status
+from fastapi.responses import PlainTextResponse
 from routers import lung_router as lung
+from routers import debug_router as debug
+from routers import admin_router as admin
+from classes.executor import executor
+from classes.batch_scheduler import scheduler
+from classes.result_store import result_store
+from classes.prediction_cache import prediction_cache
+from classes.model_versions import model_versions, traffic_split
+from classes import metrics
+import settings
+from classes.metrics import gauge, counter, histogram, DURATION_BUCKETS
+from classes.upload_limit import Upload_limit
 from fastapi_utils.tasks import repeat_every
 
 # create fastapi
 app = FastAPI()
 app.include_router(lung.router)
+app.include_router(debug.router)
+app.include_router(admin.router)
+# uploads above the maximum size are refused before they are read
+app.add_middleware(Upload_limit, limits={"/lungs": settings.MAX_UPLOAD_BYTES, "/lungs/tensor": settings.MAX_UPLOAD_BYTES,
+                                         "/lungs/batch": settings.MAX_BULK_UPLOAD_BYTES})
+startup_report.record("imports")
+# the routes that predict, the first of them that succeeds is the first prediction of the startup report
+PREDICTION_PATHS = ("/lungs", "/lungs/tensor", "/lungs/batch")
+
+# the error of the last failed attempt to load the model on startup, None while it loads or once it is loaded
+model_load_error = None
+
+requests_in_flight = gauge("http_requests_in_flight", "Requests that are being handled by this worker")
+
+
+# measures every request: the amount of requests that are handled at the same time, their duration and status code
+@app.middleware("http")
+async def measure_requests(request: Request, call_next):
+    requests_in_flight.inc()
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        requests_in_flight.dec()
+    # the path of the route instead of the url, so /lungs/results/{result_id} is one metric
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unknown"
+    histogram("http_request_duration_seconds", "Time it took to handle a request", DURATION_BUCKETS, labels={"path": path}).observe(time.perf_counter() - started)
+    counter("http_requests_total", "Handled requests", labels={"path": path, "status": response.status_code}).inc()
+    if response.status_code == 200 and path in PREDICTION_PATHS and not startup_report.done("first_prediction"):
+        startup_report.record("first_prediction")
+    return response
 
 
 # default route
@@ -14,11 +62,111 @@ async def root():
     return {"Message": "Welcome to our API, please visit /docs for the different routes/endpoints you can use."}
 
 
-# Checks on startup and every 10 minutes
+# liveness probe - the worker is running, unless its model failed to load and it won't try again (kubernetes restarts the pod)
+@app.get("/health")
+async def health(response: Response):
+    if model_load_error is not None and settings.MODEL_RELOAD_INTERVAL_SECONDS <= 0:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"Status": "model failed to load", "Error": model_load_error}
+    return {"Status": "alive"}
+
+
+# readiness probe - kubernetes only sends traffic to the pod when the model is loaded and warmed up
+@app.get("/ready")
+async def ready(response: Response):
+    if not executor.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        if model_load_error is not None:
+            return {"Status": "model failed to load", "Error": model_load_error}
+        return {"Status": "loading model"}
+    return {"Status": "ready", "Executor": executor.kind, "Workers": executor.workers, "Pending": executor.pending,
+            "Model": executor.model_version, "Startup": startup_report.stages}
+
+
+# the model versions that can be asked for and the versions this worker has loaded (with a process executor every process
+# loads its own versions, they aren't listed here)
+@app.get("/models")
+async def models():
+    return {"Default": executor.model_version, "Available": sorted(model_versions.scan()), "Loaded": list(model_versions.loaded),
+            "Canary": {"Version": traffic_split.canary_version, "Percent": traffic_split.canary_percent},
+            "Shadow": {"Version": traffic_split.shadow_version, "Percent": traffic_split.shadow_percent}}
+
+
+# all metrics of this worker as json, like the batch size and queue wait histograms to tune the batching settings
+@app.get("/stats")
+async def stats():
+    return metrics.snapshot()
+
+
+# all metrics of this worker in the prometheus text format
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# Loads the model once per worker on startup, in the background so the liveness probe keeps answering while the model loads
+@app.on_event("startup")
+async def load_model():
+    traffic_split.check(model_versions)
+    executor.start()
+    asyncio.get_event_loop().create_task(load_model_in_background())
+    if settings.MODEL_RELOAD_INTERVAL_SECONDS > 0:
+        asyncio.get_event_loop().create_task(watch_model_file(settings.MODEL_RELOAD_INTERVAL_SECONDS))
+    scheduler.start()
+
+
+# A model that can't be loaded (a missing or broken model file) is logged and loaded again every reload interval, so a model
+# that is copied onto the volume later is still picked up. Without a reload interval /health fails and the pod is restarted
+async def load_model_in_background():
+    global model_load_error
+    while True:
+        try:
+            await executor.load()
+            break
+        except Exception as e:
+            model_load_error = str(e) or type(e).__name__
+            counter("model_load_failures_total", "Attempts to load the model on startup that failed").inc()
+            if settings.MODEL_RELOAD_INTERVAL_SECONDS <= 0:
+                logging.exception("The model could not be loaded")
+                return
+            logging.exception(f"The model could not be loaded, trying again in {settings.MODEL_RELOAD_INTERVAL_SECONDS} seconds")
+            await asyncio.sleep(settings.MODEL_RELOAD_INTERVAL_SECONDS)
+    model_load_error = None
+    startup_report.record("model")
+    # the cache only keeps the predictions of the loaded model
+    prediction_cache.set_model_version(executor.model_version)
+
+
+# Loads a new model file without a restart: the file has to stay the same for one interval, so a model that is still
+# being copied isn't loaded. A model that can't be loaded is logged and tried again when the file changes again
+async def watch_model_file(interval):
+    changed_since = None
+    while True:
+        await asyncio.sleep(interval)
+        if not executor.ready or not executor.model_changed():
+            changed_since = None
+            continue
+        file_stat = executor.model_file_stat_now()
+        if file_stat != changed_since:
+            changed_since = file_stat
+            continue
+        try:
+            await admin.reload_model()
+        except Exception:
+            logging.exception("The new model file was refused, the old model is still used")
+            # remembered as loaded, so the same broken file isn't loaded every interval
+            executor.model_file_stat = file_stat
+        changed_since = None
+
+
+@app.on_event("shutdown")
+async def stop_executor():
+    await scheduler.stop()
+    executor.shutdown()
+
+
+# Removes the expired results every minute, the store also evicts results itself when a new one doesn't fit in its budget
 @app.on_event("startup")
-@repeat_every(seconds=60*10)  # repeat every 10 minutes
-def delete_images_from_directory():
-    # Checks if the image directory is empty or not
-    # if it's not empty then delete all the files ( in this case images from the directory)
-    if len(os.listdir(".//images")) > 0:
-        [os.remove(f".//images//{image}") for image in os.listdir(".//images")]
+@repeat_every(seconds=60)
+def remove_expired_results():
+    result_store.sweep()
@@ -0,0 +1,47 @@
+import hmac
+
+import settings
+from classes.executor import executor
+from classes.prediction_cache import prediction_cache
+
+from fastapi import APIRouter, Header, HTTPException
+
+
+router = APIRouter(
+    prefix = "/admin",
+    tags = ["Admin"],
+    responses = {404: {"Admin": "Not found"}}
+)
+
+
+def check_token(token):
+    # the admin routes only exist when ADMIN_TOKEN is set, and only answer requests with that token
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if token is None or not hmac.compare_digest(token, settings.ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+async def reload_model():
+    # loads the model file again, a new model is warmed up and swapped in while the old model keeps answering requests
+    changed = await executor.reload()
+    if changed:
+        # the cache only keeps the predictions of the loaded model
+        prediction_cache.set_model_version(executor.model_version)
+    return changed
+
+
+@router.post("/reload")
+async def reload(x_admin_token: str = Header(None)):
+    """
+        loads the model file again on the worker that handles this request (the other workers notice the new file
+        themselves within MODEL_RELOAD_INTERVAL_SECONDS), a model that can't be loaded or validated is refused
+    """
+    check_token(x_admin_token)
+    if not executor.ready:
+        raise HTTPException(status_code=503, detail="The model is not loaded yet")
+    try:
+        changed = await reload_model()
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"The new model was refused, the old model is still used: {e}")
+    return {"Changed": changed, "Version": executor.model_version}
@@ -0,0 +1,50 @@
+import settings
+from classes.profiler import profiler
+
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+
+
+router = APIRouter(
+    prefix = "/debug",
+    tags = ["Debug"],
+    responses = {404: {"Debug": "Not found"}}
+)
+
+
+def check_enabled():
+    # the debug routes only exist when they are enabled with PROFILER_ENABLED
+    if not settings.PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+@router.post("/profiler/start")
+async def start_profiler(interval_ms: float = Query(5, gt=0)):
+    """
+        starts the sampling profiler on the worker that handles this request
+        interval_ms: the time between two samples
+    """
+    check_enabled()
+    try:
+        profiler.start(interval_ms)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return profiler.status()
+
+
+@router.get("/profiler")
+async def profiler_status():
+    check_enabled()
+    return profiler.status()
+
+
+@router.post("/profiler/stop", response_class=PlainTextResponse)
+async def stop_profiler():
+    """
+        stops the profiler and returns the sampled stacks in the collapsed format of flamegraph.pl
+    """
+    check_enabled()
+    try:
+        return profiler.stop()
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
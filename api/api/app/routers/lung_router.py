@@ -1,9 +1,26 @@
-from classes.lung_image import *
-from classes.autoencoder import *
-from classes.segmentation_image import *
+from classes.lung_image import Lung_image
+from classes.segmentation_image import Segmentation
+from classes.pipeline import preprocess, infer, encode, decode_tensor, encode_tensor
+from classes.batch_scheduler import scheduler
+from classes.executor import executor, Executor_saturated
+from classes.result_store import result_store, create_result_id
+from classes.prediction_cache import prediction_cache
+from classes.model_versions import model_versions, traffic_split, Unknown_model_version, Model_version_failed
+from classes.bulk_upload import Bulk_upload, Zip_stream, Bulk_upload_error
+from classes.tensor import Tensor_output
+from classes.metrics import histogram, counter, DURATION_BUCKETS, SIZE_BUCKETS
 
-from fastapi import APIRouter, File
-from fastapi.responses import FileResponse
+import json
+import time
+import base64
+import asyncio
+import numpy as np
+from typing import List
+
+import settings
+from fastapi import APIRouter, File, UploadFile, HTTPException, Query, Header, Request
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
 
 router = APIRouter(
@@ -12,18 +29,418 @@ router = APIRouter(
     responses = {404: {"Lungs": "Not found"}}
 )
 
+upload_size = histogram("lungs_upload_bytes", "Size of the uploaded images", SIZE_BUCKETS)
+response_size = histogram("lungs_response_bytes", "Size of the returned segmentations", SIZE_BUCKETS)
+shadow_difference = histogram("model_shadow_difference", "Mean absolute difference between the probabilities of the shadow version and the version that answered",
+                              [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1])
+shadow_dice = histogram("model_shadow_dice", "Dice between the masks (probability above 0.5) of the shadow version and the version that answered",
+                        [0.5, 0.75, 0.9, 0.95, 0.98, 0.99, 0.995, 0.999, 1])
+
 
 @router.post("")
-async def upload_image_and_predict(input_image: bytes = File(...)):
+async def upload_image_and_predict(request: Request,
+                                   input_image: UploadFile = File(None),
+                                   image_format: str = Query(settings.OUTPUT_FORMAT, alias="format"),
+                                   quality: int = Query(settings.OUTPUT_QUALITY, ge=1, le=100),
+                                   threshold: float = Query(settings.MASK_THRESHOLD, ge=0, le=1),
+                                   size: str = Query(settings.OUTPUT_SIZE),
+                                   version: str = Query(None),
+                                   x_model_version: str = Header(None)):
     """
-        input: a x-ray image of a chest - shows the lungs
+        input: a x-ray image of a chest - shows the lungs, as the input_image field of a multipart form
+               or as the body of the request (Content-Type image/png, image/jpeg, ... or application/octet-stream)
         output: returns an image where the lungs are segmentated from the image
+        format: png, jpeg or raw (the uint8 pixels, the shape is in the X-Mask-Shape header), or a compact mask:
+                rle (COCO run-length encoding as json), bits (8 pixels per byte, numpy.packbits) or polygons (json with the
+                contour, area and bounding box of every lung)
+        quality: the jpeg quality or the png compression speed
+        threshold: returns a black and white mask instead of the probabilities as grayscale (the compact formats use 0.5 without it)
+        size: model returns the 400x400 mask, original resizes the mask back to the size of the uploaded image
+        version: the model version that predicts the image (or the X-Model-Version header), the default model when empty
+    """
+    check_output(image_format, size)
+    # The model is loaded in the background on startup, don't accept images before it is ready
+    if not executor.ready:
+        raise HTTPException(status_code=503, detail="The model is still loading")
+    # the version that was asked for, otherwise the default model or the canary version
+    model_version, reason = traffic_split.route(check_version(version or x_model_version))
+    counter("model_version_requests_total", "Requests per model version and why that version answered",
+            labels={"version": model_version, "reason": reason}).inc()
+    input_image = await read_upload(request, input_image)
+    upload_size.observe(len(input_image))
+    # An image that was uploaded before with the same options is answered from the cache without decoding or predicting it again.
+    # Hashing a large upload takes tens of milliseconds, it runs in a thread so the other connections of the worker keep going
+    cache_key = None
+    if prediction_cache.enabled:
+        cache_key = await run_in_threadpool(prediction_cache.upload_key, input_image, model_version, image_format, quality, threshold, size)
+    cached = prediction_cache.get(cache_key)
+    if cached is not None:
+        return await store_result(*cached, cache="hit", model_version=model_version)
+    try:
+        async with executor.admit():
+            # The lung image class prepares the input image for the autencoder model - for more informatie see the lung image class
+            image, timings, original_shape = await executor.run(preprocess, input_image)
+            started = time.perf_counter()
+            prediction = None
+            if prediction_cache.tensor_key_enabled:
+                tensor_key = await run_in_threadpool(prediction_cache.tensor_key, image, model_version)
+                prediction = prediction_cache.get(tensor_key)
+            if prediction is None:
+                # The batch scheduler lets the auto encoder predict this image together with the images of concurrent requests
+                prediction = await scheduler.predict(image, model_version)
+                if prediction_cache.tensor_key_enabled:
+                    prediction_cache.put(tensor_key, prediction, prediction.nbytes)
+            # the infer time includes the time the image waited for its batch
+            timings["infer"] = time.perf_counter() - started
+            version_infer_time(model_version).observe(timings["infer"])
+            shadow_version = traffic_split.shadow(model_version)
+            if shadow_version is not None:
+                asyncio.ensure_future(predict_shadow(image, prediction, shadow_version))
+            started = time.perf_counter()
+            # The Segementation image class encodes the prediction in memory so it can be sent back through the API
+            content, media_type, shape = await executor.run(encode, prediction, image_format, quality, threshold,
+                                                            original_shape if size == "original" else None)
+            timings["encode"] = time.perf_counter() - started
+    except Executor_saturated:
+        raise HTTPException(status_code=503, detail="Too many requests are being handled, try again later", headers={"Retry-After": "1"})
+    except Unknown_model_version:
+        # the version was removed from the model folder after the request was accepted
+        raise HTTPException(status_code=404, detail=f"Model version {model_version} doesn't exist")
+    except Model_version_failed as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    except ValueError as e:
+        # the uploaded file couldn't be decoded
+        raise HTTPException(status_code=400, detail=str(e))
+    prediction_cache.put(cache_key, (content, media_type, shape), len(content))
+    return await store_result(content, media_type, shape, cache="miss", timings=timings, model_version=model_version)
+
+
+async def read_upload(request, input_image):
+    # The upload is copied once into a buffer of its exact size, which is decoded without another copy: a multipart file
+    # from the file python-multipart spooled it to, a raw body straight from the stream of the request
+    if input_image is not None:
+        return await run_in_threadpool(read_spooled_file, input_image.file)
+    if request.headers.get("content-type", "").startswith("multipart/"):
+        raise HTTPException(status_code=400, detail="The form has no input_image file")
+    return await read_body(request)
+
+
+def read_spooled_file(file):
+    # the size of the spooled file is known, the buffer is filled in chunks so there is never a second copy of the whole file
+    file.seek(0, 2)
+    buffer = bytearray(file.tell())
+    file.seek(0)
+    position = 0
+    while position < len(buffer):
+        chunk = file.read(min(settings.UPLOAD_CHUNK_BYTES, len(buffer) - position))
+        if not chunk:
+            break
+        buffer[position:position + len(chunk)] = chunk
+        position += len(chunk)
+    return buffer
+
+
+async def read_body(request):
+    # the Content-Length gives the size of the buffer up front, a chunked body grows its buffer (the upload limit
+    # middleware already stopped bodies above the maximum upload size)
+    content_length = request.headers.get("content-length")
+    if content_length is None or not content_length.isdigit():
+        buffer = bytearray()
+        async for chunk in request.stream():
+            buffer += chunk
+        return buffer
+    buffer = bytearray(int(content_length))
+    position = 0
+    async for chunk in request.stream():
+        if position + len(chunk) > len(buffer):
+            raise HTTPException(status_code=400, detail="The body is longer than its Content-Length")
+        buffer[position:position + len(chunk)] = chunk
+        position += len(chunk)
+    if position != len(buffer):
+        raise HTTPException(status_code=400, detail="The body is shorter than its Content-Length")
+    return buffer
+
+
+def check_output(image_format, size):
+    if image_format not in Segmentation.MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown format {image_format}, use one of {', '.join(Segmentation.MEDIA_TYPES)}")
+    if size not in Segmentation.SIZES:
+        raise HTTPException(status_code=400, detail=f"Unknown size {size}, use one of {', '.join(Segmentation.SIZES)}")
+
+
+def check_version(version):
+    # a version that isn't in the model folder is refused before the image is decoded
+    if version and not model_versions.exists(version):
+        raise HTTPException(status_code=404, detail=f"Model version {version} doesn't exist")
+    return version
+
+
+def version_infer_time(model_version):
+    return histogram("model_version_infer_seconds", "Time the model version took to predict an image, including the wait for its batch",
+                     DURATION_BUCKETS, labels={"version": model_version})
+
+
+async def predict_shadow(image, prediction, shadow_version):
+    # Predicts the image with the shadow version after the request was answered and compares the two predictions.
+    # It counts as a request for the backpressure of the executor and is skipped when the executor is full
+    try:
+        executor.acquire()
+    except Executor_saturated:
+        counter("model_shadow_skipped_total", "Shadow predictions skipped because the executor was full").inc()
+        return
+    try:
+        started = time.perf_counter()
+        shadow_prediction = await scheduler.predict(image, shadow_version)
+        version_infer_time(shadow_version).observe(time.perf_counter() - started)
+        shadow_difference.observe(float(np.abs(shadow_prediction - prediction).mean()))
+        mask, shadow_mask = prediction > 0.5, shadow_prediction > 0.5
+        total = np.count_nonzero(mask) + np.count_nonzero(shadow_mask)
+        shadow_dice.observe(2 * np.count_nonzero(mask & shadow_mask) / total if total else 1.0)
+    except Exception:
+        counter("model_shadow_failed_total", "Shadow predictions that failed").inc()
+    finally:
+        executor.release()
+
+
+@router.post("/tensor")
+async def predict_tensor(request: Request,
+                         dtype: str = Query("float32"),
+                         output: str = Query("probabilities"),
+                         container: str = Query("raw"),
+                         threshold: float = Query(0.5, ge=0, le=1),
+                         version: str = Query(None),
+                         x_tensor_shape: str = Header(None),
+                         x_model_version: str = Header(None)):
+    """
+        input: images that are already decoded and resized to 400x400 as the body: raw little-endian float32 (0 - 1) or uint8 pixels
+               (dtype), one image or a batch with its shape in the X-Tensor-Shape header (like 8,400,400), or a numpy .npy file
+        output: the masks of the images as a tensor, their shape is in the X-Tensor-Shape header and their dtype in X-Tensor-Dtype
+        output=probabilities: the float32 probabilities, output=mask: one uint8 (0 or 1) per pixel, output=bits: the mask with
+               8 pixels per byte (numpy.packbits, 20000 bytes per image)
+        container: raw bytes or a numpy .npy file
+        threshold: the probability above which a pixel belongs to the lungs in the mask and bits outputs
+        version: the model version that predicts the images (or the X-Model-Version header), the default model when empty
+    """
+    if output not in Tensor_output.OUTPUTS:
+        raise HTTPException(status_code=400, detail=f"Unknown output {output}, use one of {', '.join(Tensor_output.OUTPUTS)}")
+    if container not in Tensor_output.MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown container {container}, use one of {', '.join(Tensor_output.MEDIA_TYPES)}")
+    if not executor.ready:
+        raise HTTPException(status_code=503, detail="The model is still loading")
+    shape = parse_shape(x_tensor_shape)
+    model_version, reason = traffic_split.route(check_version(version or x_model_version))
+    counter("model_version_requests_total", "Requests per model version and why that version answered",
+            labels={"version": model_version, "reason": reason}).inc()
+    body = await read_body(request)
+    upload_size.observe(len(body))
+    timings = {}
+    try:
+        async with executor.admit():
+            # no image codec: the body is only viewed as an array (uint8 pixels are divided by 255)
+            started = time.perf_counter()
+            images = await executor.run(decode_tensor, body, dtype, shape)
+            timings["decode"] = time.perf_counter() - started
+            started = time.perf_counter()
+            # the images of the batch are predicted together with the images of concurrent requests
+            prediction = await scheduler.predict(images, model_version)
+            timings["infer"] = time.perf_counter() - started
+            version_infer_time(model_version).observe(timings["infer"])
+            started = time.perf_counter()
+            content, media_type, mask_shape, mask_dtype = await executor.run(encode_tensor, prediction, output, container, threshold)
+            timings["encode"] = time.perf_counter() - started
+    except Executor_saturated:
+        raise HTTPException(status_code=503, detail="Too many requests are being handled, try again later", headers={"Retry-After": "1"})
+    except Unknown_model_version:
+        raise HTTPException(status_code=404, detail=f"Model version {model_version} doesn't exist")
+    except Model_version_failed as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    except ValueError as e:
+        # the body isn't a tensor of 400x400 images
+        raise HTTPException(status_code=400, detail=str(e))
+    response_size.observe(len(content))
+    record_timings(timings)
+    # the tensors aren't kept in the result store or the prediction cache, the caller already has the images
+    return Response(content=content, media_type=media_type,
+                    headers={"X-Tensor-Shape": ",".join(map(str, mask_shape)), "X-Tensor-Dtype": mask_dtype, "X-Model-Version": model_version,
+                             "Server-Timing": ", ".join(f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in timings.items())})
+
+
+def parse_shape(header):
+    # the X-Tensor-Shape header of a raw body, like 400,400 or 8,400,400
+    if not header:
+        return None
+    try:
+        shape = tuple(int(dimension) for dimension in header.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid X-Tensor-Shape {header}, use comma separated integers like 8,400,400")
+    if not shape or any(dimension < 0 for dimension in shape):
+        raise HTTPException(status_code=400, detail=f"Invalid X-Tensor-Shape {header}")
+    return shape
+
+
+@router.post("/batch")
+async def upload_images_and_predict(input_images: List[UploadFile] = File(...),
+                                    image_format: str = Query(settings.OUTPUT_FORMAT, alias="format"),
+                                    quality: int = Query(settings.OUTPUT_QUALITY, ge=1, le=100),
+                                    threshold: float = Query(settings.MASK_THRESHOLD, ge=0, le=1),
+                                    output: str = Query("ndjson"),
+                                    size: str = Query(settings.OUTPUT_SIZE),
+                                    version: str = Query(None),
+                                    x_model_version: str = Header(None)):
+    """
+        input: x-ray images of chests, or zip / tar archives of them
+        output: streams the segmentations back as soon as they are predicted
+        output=ndjson: one json object per line with the name and the base64 encoded segmentation of an image
+        output=zip: a zip archive with the segmentations
+        size: model returns 400x400 masks, original resizes every mask back to the size of its image
+        version: the model version that predicts the images (or the X-Model-Version header), the default model when empty
     """
-    # Create an object of the lung_image class which will prepare the input image for the autencoder model - for more informatie see the lung image class
-    lung_image = Lung_image(input_image)
-    # Create an object of the auto encoder class that will contain the autoencoder
-    autoencoder = Autoencoder()
-    # Create an object of the Segementation image class which will save the image so it can be sent back through the PI
-    segmentation_image = Segmentation(autoencoder.predict(lung_image.get_image()))
-    # Return the saved segmentation file to the user
-    return FileResponse(f".//images//{segmentation_image.get_image_name()}")
\ No newline at end of file
+    check_output(image_format, size)
+    if output not in ("ndjson", "zip"):
+        raise HTTPException(status_code=400, detail=f"Unknown output {output}, use ndjson or zip")
+    if not executor.ready:
+        raise HTTPException(status_code=503, detail="The model is still loading")
+    model_version, _ = traffic_split.route(check_version(version or x_model_version))
+    # a bulk upload counts as one request for the backpressure of the executor, it is released when the response ends
+    try:
+        executor.acquire()
+    except Executor_saturated:
+        raise HTTPException(status_code=503, detail="Too many requests are being handled, try again later", headers={"Retry-After": "1"})
+    segmentations = predict_bulk(Bulk_upload(input_images), image_format, quality, threshold, size, model_version)
+    if output == "zip":
+        return Admitted_streaming_response(stream_zip(segmentations, image_format), media_type="application/zip",
+                                           headers={"Content-Disposition": "attachment; filename=segmentations.zip", "X-Model-Version": model_version})
+    return Admitted_streaming_response(stream_ndjson(segmentations), media_type="application/x-ndjson", headers={"X-Model-Version": model_version})
+
+
+class Admitted_streaming_response(StreamingResponse):
+
+    def __init__(self, *args, **kwargs):
+        # A streaming response that holds a request of the executor until the response is done, also when the client
+        # disconnects or the response fails before its body was started (then the body generator never runs its finally)
+        super().__init__(*args, **kwargs)
+        self.admitted = True
+
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # released once, whatever ends the response
+            if self.admitted:
+                self.admitted = False
+                executor.release()
+
+
+async def predict_bulk(bulk_upload, image_format, quality, threshold, size, model_version):
+    # The images are handled in chunks: the images of a chunk are decoded in parallel, predicted as one batch
+    # and encoded in parallel, while the next chunk is already being read and decoded
+    chunks = bulk_upload.chunks(settings.BULK_BATCH_SIZE)
+    decoding = asyncio.ensure_future(read_and_decode(chunks))
+    while True:
+        names, images, shapes, errors = await decoding
+        if not names and not errors:
+            return
+        decoding = asyncio.ensure_future(read_and_decode(chunks))
+        for name, error in errors:
+            yield name, error, None
+        if not names:
+            continue
+        predictions = await executor.run(infer, images, model_version)
+        encoded = await asyncio.gather(*[executor.run(encode, prediction, image_format, quality, threshold, shape if size == "original" else None)
+                                         for prediction, shape in zip(predictions, shapes)])
+        for name, segmentation in zip(names, encoded):
+            yield name, None, segmentation
+
+
+async def read_and_decode(chunks):
+    # reading the archive is blocking file io, so it runs in a thread
+    chunk = await run_in_threadpool(next, chunks, [])
+    names, images, shapes, errors = [], [], [], []
+    # the images that were too large to read and the archives that couldn't be read are not decoded
+    errors.extend((name, str(data)) for name, data in chunk if isinstance(data, Bulk_upload_error))
+    chunk = [(name, data) for name, data in chunk if not isinstance(data, Bulk_upload_error)]
+    # in a thread pool every image is decoded straight into its row of the batch, a process sends every image back on its own
+    batch = np.empty((len(chunk), Lung_image.SIZE, Lung_image.SIZE), dtype=np.float32) if executor.kind == "thread" else None
+    decoded = await asyncio.gather(*[executor.run(preprocess, data, None if batch is None else batch[index])
+                                     for index, (_, data) in enumerate(chunk)], return_exceptions=True)
+    rows = []
+    for index, ((name, _), result) in enumerate(zip(chunk, decoded)):
+        if isinstance(result, Exception):
+            errors.append((name, "Could not read the image"))
+        else:
+            names.append(name)
+            rows.append(index)
+            images.append(result[0])
+            shapes.append(result[2])
+    if not names:
+        return names, None, shapes, errors
+    if batch is None:
+        return names, np.concatenate(images), shapes, errors
+    # the rows of the images that couldn't be read are left out, only then the batch is copied
+    return names, batch if len(rows) == len(batch) else batch[rows], shapes, errors
+
+
+async def stream_ndjson(segmentations):
+    async for name, error, segmentation in segmentations:
+        if error is not None:
+            line = {"name": name, "error": error}
+        else:
+            content, media_type, shape = segmentation
+            # the json formats are embedded as they are, the other formats as base64
+            mask = json.loads(content) if media_type == "application/json" else base64.b64encode(content).decode()
+            line = {"name": name, "media_type": media_type, "shape": shape, "mask": mask}
+        yield json.dumps(line) + "\n"
+
+
+async def stream_zip(segmentations, image_format):
+    archive = Zip_stream()
+    async for name, error, segmentation in segmentations:
+        if error is not None:
+            yield archive.add(f"{name}.error.txt", error)
+        else:
+            yield archive.add(name, segmentation[0], image_format)
+    yield archive.close()
+
+
+@router.get("/results/{result_id}")
+async def get_result(result_id: str):
+    """
+        input: the result id of an earlier segmentation (the X-Result-Id header)
+        output: returns the same segmentation, until it expired or was removed to make place for newer results
+    """
+    result = await run_store(result_store.get, result_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"Result {result_id} doesn't exist or expired")
+    return segmentation_response(result_id, *result)
+
+
+async def run_store(function, *args):
+    # the disk store pickles and reads or writes files, it runs in a thread so the event loop keeps answering other requests
+    if result_store.blocking:
+        return await run_in_threadpool(function, *args)
+    return function(*args)
+
+
+async def store_result(content, media_type, shape, cache, timings=None, model_version=None):
+    # Keep the segmentation in the result store, so it can be downloaded again with its result id
+    result_id = create_result_id()
+    await run_store(result_store.put, result_id, (content, media_type, shape), len(content))
+    response_size.observe(len(content))
+    # Return the encoded segmentation to the user, the Server-Timing header shows how long every stage took (in ms)
+    headers = {"X-Cache": cache, "X-Model-Version": model_version}
+    if timings:
+        record_timings(timings)
+        headers["Server-Timing"] = ", ".join(f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in timings.items())
+    return segmentation_response(result_id, content, media_type, shape, headers)
+
+
+def record_timings(timings):
+    # every stage has its own histogram, so the metrics show where the time of a request goes
+    for stage, seconds in timings.items():
+        histogram("lungs_stage_duration_seconds", "Time every stage of a prediction took", DURATION_BUCKETS, labels={"stage": stage}).observe(seconds)
+
+
+def segmentation_response(result_id, content, media_type, shape, headers=None):
+    headers = {"X-Mask-Shape": ",".join(map(str, shape)), "X-Result-Id": result_id, **(headers or {})}
+    return Response(content=content, media_type=media_type, headers=headers)
\ No newline at end of file
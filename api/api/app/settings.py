@@ -0,0 +1,79 @@
+import os
+import tempfile
+
+# All settings of the API can be overwritten with environment variables (see the env section in the helm chart values)
+
+# Model settings
+MODEL_PATH = os.environ.get("MODEL_PATH", ".//model//lung-model.onnx")
+# the amount of onnx sessions every gunicorn worker keeps in its pool
+MODEL_POOL_SIZE = int(os.environ.get("MODEL_POOL_SIZE", 1))
+# threads used inside one operator (matmul, conv, ...) and between independent operators, 0 lets onnxruntime decide
+MODEL_INTRA_OP_THREADS = int(os.environ.get("MODEL_INTRA_OP_THREADS", 0))
+MODEL_INTER_OP_THREADS = int(os.environ.get("MODEL_INTER_OP_THREADS", 0))
+# the model file is checked every interval and a new model is loaded and swapped in without a restart, 0 disables the check
+MODEL_RELOAD_INTERVAL_SECONDS = float(os.environ.get("MODEL_RELOAD_INTERVAL_SECONDS", 30))
+# Serve the weights from a memory mapped copy of the model, written once per model version in the shared directory, so all gunicorn
+# workers of a pod share one copy of the weights instead of holding one each. The weights are not prepacked, so larger batches are slower.
+# The folder is kept in the container, a restart starts empty
+MODEL_SHARED_WEIGHTS = os.environ.get("MODEL_SHARED_WEIGHTS", "false") == "true"
+MODEL_SHARED_DIRECTORY = os.environ.get("MODEL_SHARED_DIRECTORY", os.path.join(tempfile.gettempdir(), "lung-model-shared"))
+# POST /admin/reload loads a new model immediately, the route only exists when a token is set (sent in the X-Admin-Token header)
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# Model version settings - dated copies of the model ({day}_{month}_{year}_{name}_{version}.onnx, see 04_DownloadModel.py)
+# in this folder can be asked for with the X-Model-Version header or the version query parameter. A version is loaded on
+# first use, the least recently used versions are unloaded when the loaded versions don't fit in the byte budget
+MODEL_VERSIONS_DIRECTORY = os.environ.get("MODEL_VERSIONS_DIRECTORY", ".//model//versions")
+MODEL_VERSIONS_MAX_BYTES = int(os.environ.get("MODEL_VERSIONS_MAX_BYTES", 512 * 1024 * 1024))
+# a percentage of the requests without a version is answered by the canary version instead of the default model
+MODEL_CANARY_VERSION = os.environ.get("MODEL_CANARY_VERSION", "")
+MODEL_CANARY_PERCENT = float(os.environ.get("MODEL_CANARY_PERCENT", 0))
+# a percentage of the requests is also predicted by the shadow version in the background, to compare latency and masks (see /metrics)
+MODEL_SHADOW_VERSION = os.environ.get("MODEL_SHADOW_VERSION", "")
+MODEL_SHADOW_PERCENT = float(os.environ.get("MODEL_SHADOW_PERCENT", 0))
+
+# Micro-batching settings - concurrent requests are collected into one batch until it is full or the oldest request waited long enough
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 8))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 5))
+
+# Executor settings - decoding, inference and encoding run in a "thread" or "process" pool instead of on the event loop
+EXECUTOR_KIND = os.environ.get("EXECUTOR_KIND", "thread")
+EXECUTOR_WORKERS = int(os.environ.get("EXECUTOR_WORKERS", os.cpu_count() or 1))
+# the maximum amount of requests a worker handles at the same time, every request above this gets a 503
+EXECUTOR_MAX_PENDING = int(os.environ.get("EXECUTOR_MAX_PENDING", 64))
+
+# Output settings - the default encoding of the segmentation, every request can choose its own with query parameters
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "jpeg")
+OUTPUT_QUALITY = int(os.environ.get("OUTPUT_QUALITY", 90))
+# pixels with a lung probability above the threshold become white, the others black - leave it empty to return the probabilities as grayscale
+MASK_THRESHOLD = float(os.environ["MASK_THRESHOLD"]) if os.environ.get("MASK_THRESHOLD") else None
+# the size of the returned mask: "model" (400x400) or "original" (resized back to the size of the uploaded image)
+OUTPUT_SIZE = os.environ.get("OUTPUT_SIZE", "model")
+# the polygons format simplifies the lung contours, a point may move up to this many pixels (0 keeps every point of the contour)
+POLYGON_EPSILON = float(os.environ.get("POLYGON_EPSILON", 1.0))
+
+# Result store settings - every segmentation can be downloaded again with its result id until it expires or the memory budget is full.
+# The memory store is per worker, a result can only be downloaded from the worker that made it - with more than one worker
+# use the disk store, it is shared by all workers of a pod (the helm chart does)
+RESULT_STORE_KIND = os.environ.get("RESULT_STORE_KIND", "memory")
+RESULT_STORE_DIRECTORY = os.environ.get("RESULT_STORE_DIRECTORY", ".//images")
+RESULT_STORE_MAX_BYTES = int(os.environ.get("RESULT_STORE_MAX_BYTES", 256 * 1024 * 1024))
+RESULT_STORE_TTL_SECONDS = float(os.environ.get("RESULT_STORE_TTL_SECONDS", 60 * 10))
+
+# Prediction cache settings - an image that was uploaded before is answered from the cache, set the budget to 0 to disable it
+PREDICTION_CACHE_MAX_BYTES = int(os.environ.get("PREDICTION_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+PREDICTION_CACHE_TTL_SECONDS = float(os.environ.get("PREDICTION_CACHE_TTL_SECONDS", 60 * 60))
+# also cache the prediction by the preprocessed image, so the same x-ray in another file format or size skips the model too
+PREDICTION_CACHE_TENSOR_KEY = os.environ.get("PREDICTION_CACHE_TENSOR_KEY", "false") == "true"
+
+# Upload settings - larger uploads are refused with a 413 before they are read
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 32 * 1024 * 1024))
+MAX_BULK_UPLOAD_BYTES = int(os.environ.get("MAX_BULK_UPLOAD_BYTES", 1024 * 1024 * 1024))
+# the size of the pieces a multipart upload is copied in from its spooled file
+UPLOAD_CHUNK_BYTES = int(os.environ.get("UPLOAD_CHUNK_BYTES", 1024 * 1024))
+
+# Bulk settings - the amount of images of a bulk upload that are decoded and predicted together
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", 32))
+
+# Debug settings - the sampling profiler can be started and stopped on a worker with the /debug/profiler routes
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "false") == "true"
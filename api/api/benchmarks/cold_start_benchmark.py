@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import httpx
+
+from load_test import APP_DIRECTORY, create_images, free_port
+from synthetic_model import create_dense_model
+
+
+# Measures the cold start of one api worker: the time from starting uvicorn until the first successful POST /lungs and the
+# resident memory (RSS) of the worker after it, over several runs (linux only). The startup report of the worker (/ready)
+# splits the time into imports, model load and first prediction. --app compares another checkout of the api
+#   python benchmarks/cold_start_benchmark.py --runs 5
+#   python benchmarks/cold_start_benchmark.py --runs 5 --app ../old/api/api/app --model lung-model.onnx
+
+
+def resident_memory(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def cold_start(app_directory, env, image, timeout=120):
+    # returns the seconds until the first successful prediction, the RSS of the worker after it and its startup report
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                              cwd=app_directory, env=env)
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=30) as client:
+            while True:
+                if time.perf_counter() - started > timeout:
+                    raise TimeoutError("The api didn't answer a prediction in time")
+                try:
+                    # a 503 while the model loads, a connection error before uvicorn listens
+                    if client.post("/lungs", files={"input_image": ("xray.png", image, "image/png")}).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.01)
+            seconds = time.perf_counter() - started
+            memory = resident_memory(server.pid)
+            report = client.get("/ready").json().get("Startup")
+    finally:
+        server.terminate()
+        server.wait()
+    return seconds, memory, report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--app", type=str, default=APP_DIRECTORY, help="the app folder of the api that is started")
+    parser.add_argument("--model", type=str, default=None, help="an onnx model, a synthetic dense model by default")
+    parser.add_argument("--latent_dim", type=int, default=64, help="latent size of the synthetic model (64 is a model of about 80 MB, like the trained model)")
+    parser.add_argument("--env", action="append", default=[], help="api settings as KEY=VALUE")
+    args = parser.parse_args()
+
+    image = create_images(400, 1)[0]
+    with tempfile.TemporaryDirectory() as directory:
+        model_path = os.path.abspath(args.model) if args.model else create_dense_model(os.path.join(directory, "synthetic-model.onnx"), args.latent_dim)
+        model_size = os.path.getsize(model_path)
+        env = {**os.environ, "MODEL_PATH": model_path, "PREDICTION_CACHE_MAX_BYTES": "0", "MODEL_RELOAD_INTERVAL_SECONDS": "0"}
+        env.update(setting.split("=", 1) for setting in args.env)
+        runs = [cold_start(os.path.abspath(args.app), env, image) for _ in range(args.runs)]
+
+    seconds = [run[0] for run in runs]
+    memory = [run[1] / 2 ** 20 for run in runs]
+    print(f"{args.runs} cold starts with a model of {model_size / 2 ** 20:.0f} MB")
+    print(f"time to first /lungs   median {statistics.median(seconds):6.2f} s   min {min(seconds):6.2f} s")
+    print(f"RSS after first /lungs median {statistics.median(memory):6.1f} MB  min {min(memory):6.1f} MB")
+    reports = [run[2] for run in runs if run[2]]
+    for stage in (reports[0] if reports else {}):
+        stage_seconds = statistics.median(report[stage]["seconds"] for report in reports if stage in report)
+        stage_memory = statistics.median(report[stage]["rss_bytes"] for report in reports if stage in report) / 2 ** 20
+        print(f"  {stage:<18} done after {stage_seconds:6.2f} s, RSS {stage_memory:6.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+import cv2
+import httpx
+import numpy as np
+
+from synthetic_model import MODELS
+
+
+# Load test of the /lungs endpoint: starts the api in this process or with uvicorn, sends requests with a fixed concurrency
+# and reports the throughput, the latency percentiles and the time every stage took (from the Server-Timing header)
+#   python benchmarks/load_test.py --concurrency 16 --requests 500 --output results.json
+#   python benchmarks/load_test.py --mode uvicorn --workers 2 --env EXECUTOR_KIND=process --baseline results.json
+
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+
+def create_images(size, amount, seed=42):
+    # smooth grayscale images that compress like an x-ray, instead of random noise
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(amount):
+        image = cv2.resize(rng.integers(0, 256, (32, 32), dtype=np.uint8), (size, size), interpolation=cv2.INTER_CUBIC)
+        images.append(cv2.imencode(".png", image)[1].tobytes())
+    return images
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=APP_DIRECTORY, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_server_timing(header):
+    # "decode;dur=1.2, resize;dur=0.3" -> {"decode": 1.2, "resize": 0.3}
+    stages = {}
+    for metric in filter(None, (part.strip() for part in (header or "").split(","))):
+        name, _, duration = metric.partition(";dur=")
+        if duration:
+            stages[name] = float(duration)
+    return stages
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values)
+    return {"mean": float(values.mean()), "p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95)),
+            "p99": float(np.percentile(values, 99)), "max": float(values.max())}
+
+
+async def wait_until_ready(client, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/ready")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError("The api didn't get ready in time")
+
+
+async def send_requests(client, images, args):
+    # every worker sends its next request as soon as the previous one is answered
+    results = []
+    counter = iter(range(args.requests))
+
+    async def worker():
+        for number in counter:
+            image = images[number % len(images)]
+            started = time.perf_counter()
+            response = await client.post(f"/lungs?format={args.format}", files={"input_image": ("xray.png", image, "image/png")})
+            latency = time.perf_counter() - started
+            results.append((latency, response.status_code, parse_server_timing(response.headers.get("server-timing"))))
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    return results, time.perf_counter() - started
+
+
+def summarize(results, duration, args):
+    succeeded = [result for result in results if result[1] == 200]
+    stages = {}
+    for _, _, timings in succeeded:
+        for stage, milliseconds in timings.items():
+            stages.setdefault(stage, []).append(milliseconds)
+    status_codes = {}
+    for _, status_code, _ in results:
+        status_codes[str(status_code)] = status_codes.get(str(status_code), 0) + 1
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args),
+        "requests": len(results),
+        "errors": len(results) - len(succeeded),
+        "status_codes": status_codes,
+        "duration_seconds": duration,
+        "throughput": len(succeeded) / duration,
+        "latency_ms": percentiles([latency * 1000 for latency, _, _ in succeeded]),
+        "stages_ms": {stage: percentiles(values) for stage, values in stages.items()},
+    }
+
+
+def print_summary(summary, baseline=None):
+    def line(name, value, old=None, unit=""):
+        text = f"{name:24} {value:10.2f} {unit}"
+        if old:
+            text += f"   (baseline {old:.2f}, {(value - old) / old * 100:+.1f}%)"
+        print(text)
+
+    print(f"{summary['requests']} requests, {summary['errors']} errors {summary['status_codes']} in {summary['duration_seconds']:.1f} s")
+    line("throughput", summary["throughput"], baseline and baseline["throughput"], "req/s")
+    for percentile in ("p50", "p95", "p99"):
+        if summary["latency_ms"]:
+            old = baseline and baseline["latency_ms"] and baseline["latency_ms"][percentile]
+            line(f"latency {percentile}", summary["latency_ms"][percentile], old, "ms")
+    for stage, values in summary["stages_ms"].items():
+        old = baseline and baseline["stages_ms"].get(stage) and baseline["stages_ms"][stage]["mean"]
+        line(f"{stage} mean", values["mean"], old, "ms")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run_in_process(images, args):
+    # the settings of the api are read from the environment when it is imported
+    os.chdir(APP_DIRECTORY)
+    sys.path.insert(0, APP_DIRECTORY)
+    from main import app
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://api", timeout=300) as client:
+            await wait_until_ready(client)
+            await send_requests(client, images, argparse.Namespace(**{**vars(args), "requests": args.warmup}))
+            return await send_requests(client, images, args)
+
+
+async def run_with_uvicorn(images, args):
+    port = free_port()
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(args.workers), "--log-level", "warning"]
+    server = subprocess.Popen(command, cwd=APP_DIRECTORY, env=os.environ.copy())
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=300, limits=limits) as client:
+            await wait_until_ready(client)
+            await send_requests(client, images, argparse.Namespace(**{**vars(args), "requests": args.warmup}))
+            return await send_requests(client, images, args)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn"], default="inprocess")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10, help="requests sent before measuring")
+    parser.add_argument("--model", type=str, default=None, help="the onnx model, a synthetic model when empty")
+    parser.add_argument("--arch", choices=list(MODELS), default="dense", help="the architecture of the synthetic model")
+    parser.add_argument("--image", type=str, default=None, help="the uploaded image, synthetic images when empty")
+    parser.add_argument("--image-size", type=int, default=1024, help="width and height of the synthetic images")
+    parser.add_argument("--images", type=int, default=64, help="amount of different synthetic images")
+    parser.add_argument("--format", type=str, default="jpeg", help="the output format that is requested")
+    parser.add_argument("--env", action="append", default=[], help="api settings as KEY=VALUE, like EXECUTOR_KIND=process")
+    parser.add_argument("--output", type=str, default=None, help="writes the results as json")
+    parser.add_argument("--baseline", type=str, default=None, help="json results of an earlier run to compare with")
+    args = parser.parse_args()
+    # the in process api runs in the app folder, the result files stay relative to the folder the benchmark was started in
+    args.output = os.path.abspath(args.output) if args.output else None
+    args.baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    with tempfile.TemporaryDirectory() as directory:
+        model = args.model
+        if model is None:
+            model = MODELS[args.arch](os.path.join(directory, "synthetic-model.onnx"))
+        os.environ["MODEL_PATH"] = os.path.abspath(model)
+        # every request has to reach the model, unless the cache is enabled with --env
+        os.environ["PREDICTION_CACHE_MAX_BYTES"] = "0"
+        for setting in args.env:
+            key, _, value = setting.partition("=")
+            os.environ[key] = value
+        if args.image:
+            with open(args.image, "rb") as f:
+                images = [f.read()]
+        else:
+            images = create_images(args.image_size, args.images)
+
+        run = run_with_uvicorn if args.mode == "uvicorn" else run_in_process
+        results, duration = asyncio.run(run(images, args))
+
+    summary = summarize(results, duration, args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_summary(summary, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
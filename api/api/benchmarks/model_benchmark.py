@@ -0,0 +1,62 @@
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import onnx
+import onnxruntime as rt
+
+from synthetic_model import MODELS, SIZE
+
+
+# Compares onnx models on the cpu: the amount of parameters, the size of the file and the inference latency per batch size.
+# Synthetic models of every architecture are used unless models are given
+#   python benchmarks/model_benchmark.py --batch-sizes 1 8 --repeat 50
+#   python benchmarks/model_benchmark.py --model dense=outputs/dense.onnx --model conv=outputs/conv.onnx
+
+
+def count_parameters(path):
+    model = onnx.load(path)
+    return sum(int(np.prod(initializer.dims)) for initializer in model.graph.initializer)
+
+
+def measure_latency(path, batch_size, repeat, threads):
+    options = rt.SessionOptions()
+    if threads:
+        options.intra_op_num_threads = threads
+    session = rt.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+    input_name = session.get_inputs()[0].name
+    images = np.random.default_rng(42).random((batch_size, SIZE, SIZE), dtype=np.float32)
+    # the first runs allocate the memory of the session
+    for _ in range(3):
+        session.run(None, {input_name: images})
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        session.run(None, {input_name: images})
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", action="append", default=[], help="NAME=PATH of an onnx model, synthetic models when empty")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=0, help="intra op threads of onnxruntime, all cores when 0")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        models = dict(model.split("=", 1) for model in args.model)
+        if not models:
+            models = {arch: create(os.path.join(directory, f"{arch}.onnx")) for arch, create in MODELS.items()}
+        print(f"{'model':10} {'parameters':>12} {'file':>10} " + " ".join(f"{f'batch {size} p50/p95':>22}" for size in args.batch_sizes))
+        for name, path in models.items():
+            latencies = [measure_latency(path, size, args.repeat, args.threads) for size in args.batch_sizes]
+            print(f"{name:10} {count_parameters(path):12,d} {os.path.getsize(path) / 2 ** 20:7.2f} MB "
+                  + " ".join(f"{p50:10.2f}/{p95:8.2f} ms" for p50, p95 in latencies))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# the benchmark uses the classes of the api
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from classes.lung_image import Lung_image
+
+
+# Compares the preprocessing of the api with the old pillow + float64 path:
+# the time every stage takes and the memory it allocates per image
+#   python benchmarks/preprocess_benchmark.py image.png --repeat 200
+
+
+def old_preprocessing(uploaded_image):
+    # the preprocessing before the uint8 path: pillow decode, float64 normalisation, float64 resize and a float32 copy for the model
+    timings = {}
+    start = time.perf_counter()
+    image = np.array(Image.open(BytesIO(uploaded_image))) / 255
+    timings["decode"] = time.perf_counter() - start
+    start = time.perf_counter()
+    image = cv2.resize(image, (400, 400)).reshape(-1, 400, 400)
+    timings["resize"] = time.perf_counter() - start
+    start = time.perf_counter()
+    image = image.astype(np.float32)
+    timings["normalize"] = time.perf_counter() - start
+    return image, timings
+
+
+def new_preprocessing(uploaded_image, out):
+    lung_image = Lung_image(uploaded_image, out=out)
+    return lung_image.get_image(), lung_image.get_timings()
+
+
+def measure(name, function, repeat):
+    # runs the preprocessing repeat times and reports the mean time per stage and the peak memory numpy and opencv allocate in one run
+    totals = {}
+    for _ in range(repeat):
+        _, timings = function()
+        for stage, seconds in timings.items():
+            totals[stage] = totals.get(stage, 0) + seconds
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stages = ", ".join(f"{stage} {seconds / repeat * 1000:.3f} ms" for stage, seconds in totals.items())
+    print(f"{name:5} total {sum(totals.values()) / repeat * 1000:.3f} ms ({stages}) - peak allocated {peak / 1024:.0f} kB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image", type=str, help="the x-ray image to preprocess")
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    with open(args.image, "rb") as f:
+        uploaded_image = f.read()
+    print(f"{args.image}: {len(uploaded_image) / 1024:.0f} kB")
+    # the new path writes into a preallocated image of a batch
+    batch = np.empty((1, 400, 400), dtype=np.float32)
+    measure("old", lambda: old_preprocessing(uploaded_image), args.repeat)
+    measure("new", lambda: new_preprocessing(uploaded_image, batch[0]), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
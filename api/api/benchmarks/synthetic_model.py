@@ -0,0 +1,115 @@
+import argparse
+
+import numpy as np
+import onnx
+from onnx import helper, numpy_helper, TensorProto
+
+
+# Builds onnx models with the same input and output as lung-model.onnx (a batch of 400x400 float32 images),
+# so the api can be benchmarked without a trained model
+#   python benchmarks/synthetic_model.py synthetic-model.onnx --arch conv
+
+
+SIZE = 400
+# the conv model works on 4x4 patches of the image (100x100) and upsamples the mask to 400x400
+STEM_STRIDE = 4
+
+
+def create_dense_model(path, latent_dim=64, seed=42):
+    # The same layers as the Autoencoder in train.py: Flatten -> Dense(64, relu) -> Dense(400*400, sigmoid) -> Reshape
+    rng = np.random.default_rng(seed)
+    pixels = SIZE * SIZE
+    initializers = [
+        numpy_helper.from_array(np.array([-1, pixels], dtype=np.int64), "flatten_shape"),
+        numpy_helper.from_array((rng.standard_normal((pixels, latent_dim)) / np.sqrt(pixels)).astype(np.float32), "encoder_kernel"),
+        numpy_helper.from_array(np.zeros(latent_dim, dtype=np.float32), "encoder_bias"),
+        numpy_helper.from_array((rng.standard_normal((latent_dim, pixels)) / np.sqrt(latent_dim)).astype(np.float32), "decoder_kernel"),
+        numpy_helper.from_array(np.zeros(pixels, dtype=np.float32), "decoder_bias"),
+        numpy_helper.from_array(np.array([-1, SIZE, SIZE], dtype=np.int64), "image_shape"),
+    ]
+    nodes = [
+        helper.make_node("Reshape", ["input_1", "flatten_shape"], ["flatten"]),
+        helper.make_node("Gemm", ["flatten", "encoder_kernel", "encoder_bias"], ["encoded"]),
+        helper.make_node("Relu", ["encoded"], ["latent"]),
+        helper.make_node("Gemm", ["latent", "decoder_kernel", "decoder_bias"], ["decoded"]),
+        helper.make_node("Sigmoid", ["decoded"], ["probabilities"]),
+        helper.make_node("Reshape", ["probabilities", "image_shape"], ["output_1"]),
+    ]
+    return save_model(path, "dense_autoencoder", nodes, initializers)
+
+
+def create_conv_model(path, filters=(8, 16, 32), seed=42):
+    # The same layers as the Conv_autoencoder in train.py: a 4x4 patch stem, two 3x3 convolutions per resolution,
+    # max pooling on the way down, nearest upsampling + the features of the same resolution on the way up,
+    # a 1x1 convolution and a bilinear upsampling of the logits to 400x400
+    rng = np.random.default_rng(seed)
+    initializers = [
+        numpy_helper.from_array(np.array([-1, 1, SIZE, SIZE], dtype=np.int64), "channels_shape"),
+        numpy_helper.from_array(np.array([1, 1, 2, 2], dtype=np.float32), "upsample_scales"),
+        numpy_helper.from_array(np.array([1, 1, STEM_STRIDE, STEM_STRIDE], dtype=np.float32), "output_scales"),
+        numpy_helper.from_array(np.array([-1, SIZE, SIZE], dtype=np.int64), "image_shape"),
+    ]
+    nodes = [helper.make_node("Reshape", ["input_1", "channels_shape"], ["x"])]
+
+    def conv(name, input_name, in_channels, out_channels, kernel_size=3, activation="Relu", stride=1):
+        fan_in = in_channels * kernel_size * kernel_size
+        kernel = rng.standard_normal((out_channels, in_channels, kernel_size, kernel_size)) * np.sqrt(2 / fan_in)
+        initializers.append(numpy_helper.from_array(kernel.astype(np.float32), f"{name}_kernel"))
+        initializers.append(numpy_helper.from_array(np.zeros(out_channels, dtype=np.float32), f"{name}_bias"))
+        padding = (kernel_size - 1) // 2 if stride == 1 else 0
+        nodes.append(helper.make_node("Conv", [input_name, f"{name}_kernel", f"{name}_bias"], [f"{name}_conv"],
+                                      kernel_shape=[kernel_size, kernel_size], pads=[padding] * 4, strides=[stride, stride]))
+        nodes.append(helper.make_node(activation, [f"{name}_conv"], [name]))
+        return name
+
+    def block(name, input_name, in_channels, out_channels):
+        return conv(f"{name}_2", conv(f"{name}_1", input_name, in_channels, out_channels), out_channels, out_channels)
+
+    x, channels, skips = conv("stem", "x", 1, filters[0], kernel_size=STEM_STRIDE, stride=STEM_STRIDE), filters[0], []
+    for level, out_channels in enumerate(filters[:-1]):
+        x = block(f"down{level}", x, channels, out_channels)
+        skips.append((x, out_channels))
+        nodes.append(helper.make_node("MaxPool", [x], [f"pool{level}"], kernel_shape=[2, 2], strides=[2, 2]))
+        x, channels = f"pool{level}", out_channels
+    x = block("bottleneck", x, channels, filters[-1])
+    channels = filters[-1]
+    for level, (skip, skip_channels) in reversed(list(enumerate(skips))):
+        nodes.append(helper.make_node("Resize", [x, "", "upsample_scales"], [f"upsample{level}"], mode="nearest"))
+        nodes.append(helper.make_node("Concat", [f"upsample{level}", skip], [f"concat{level}"], axis=1))
+        x = block(f"up{level}", f"concat{level}", channels + skip_channels, skip_channels)
+        channels = skip_channels
+    x = conv("segmentation", x, channels, 1, kernel_size=1, activation="Identity")
+    nodes.append(helper.make_node("Resize", [x, "", "output_scales"], ["logits"], mode="linear"))
+    nodes.append(helper.make_node("Sigmoid", ["logits"], ["probabilities"]))
+    nodes.append(helper.make_node("Reshape", ["probabilities", "image_shape"], ["output_1"]))
+    return save_model(path, "conv_autoencoder", nodes, initializers)
+
+
+MODELS = {"dense": create_dense_model, "conv": create_conv_model}
+
+
+def save_model(path, name, nodes, initializers):
+    graph = helper.make_graph(nodes, name,
+                              [helper.make_tensor_value_info("input_1", TensorProto.FLOAT, ["N", SIZE, SIZE])],
+                              [helper.make_tensor_value_info("output_1", TensorProto.FLOAT, ["N", SIZE, SIZE])],
+                              initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    # an ir version every onnxruntime release since 1.10 can read
+    model.ir_version = 7
+    onnx.checker.check_model(model)
+    onnx.save(model, path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="where the onnx model is saved")
+    parser.add_argument("--arch", choices=list(MODELS), default="dense")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    MODELS[args.arch](args.path, seed=args.seed)
+    print(f"Saved the synthetic model to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import cv2
+import httpx
+import numpy as np
+
+from load_test import APP_DIRECTORY, free_port, wait_until_ready
+from synthetic_model import create_dense_model
+
+
+# Measures the peak memory (RSS) of an api worker per upload that is being handled: the worker is started with uvicorn,
+# its peak RSS is reset after the warm-up and read again after sending large images with a fixed concurrency (linux only).
+# The memory per upload is the peak above the RSS of the worker once the model was loaded
+#   python benchmarks/upload_benchmark.py --size 4000 --concurrency 8
+#   python benchmarks/upload_benchmark.py --size 4000 --concurrency 8 --upload raw
+
+
+def create_image(size, seed=42):
+    # a 16 bit grayscale png, like an x-ray exported from dicom
+    rng = np.random.default_rng(seed)
+    image = cv2.resize(rng.integers(0, 65536, (64, 64), dtype=np.uint16), (size, size), interpolation=cv2.INTER_CUBIC)
+    image += rng.integers(0, 256, (size, size), dtype=np.uint16)
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+def memory(pid):
+    # the current and the peak resident memory of the process in bytes
+    values = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM"):
+                values[key] = int(value.split()[0]) * 1024
+    return values["VmRSS"], values["VmHWM"]
+
+
+def reset_peak(pid):
+    # writing 5 to clear_refs resets the peak RSS (VmHWM) to the current RSS
+    with open(f"/proc/{pid}/clear_refs", "w") as f:
+        f.write("5")
+
+
+async def send(client, image, upload):
+    if upload == "raw":
+        response = await client.post("/lungs", content=image, headers={"Content-Type": "image/png"})
+    else:
+        response = await client.post("/lungs", files={"input_image": ("xray.png", image, "image/png")})
+    return response.status_code
+
+
+async def run(pid, port, image, args):
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=300) as client:
+        await wait_until_ready(client)
+        # the memory of the loaded model, before any upload
+        baseline, _ = memory(pid)
+        for _ in range(2):
+            await asyncio.gather(*[send(client, image, args.upload) for _ in range(args.concurrency)])
+        # the peak of the warm-up (like the first batch that allocates the memory of the session) isn't measured
+        reset_peak(pid)
+        started = time.perf_counter()
+        status_codes = []
+        for _ in range(args.rounds):
+            status_codes += await asyncio.gather(*[send(client, image, args.upload) for _ in range(args.concurrency)])
+        duration = time.perf_counter() - started
+        _, peak = memory(pid)
+    return baseline, peak, duration, status_codes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=4000, help="width and height of the uploaded png")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--upload", choices=["multipart", "raw"], default="multipart", help="raw sends the png as the body")
+    parser.add_argument("--env", action="append", default=[], help="api settings as KEY=VALUE")
+    args = parser.parse_args()
+
+    image = create_image(args.size)
+    with tempfile.TemporaryDirectory() as directory:
+        env = {**os.environ, "MODEL_PATH": create_dense_model(os.path.join(directory, "synthetic-model.onnx")),
+               "PREDICTION_CACHE_MAX_BYTES": "0", "MAX_UPLOAD_BYTES": str(len(image) + 1024 * 1024)}
+        env.update(setting.split("=", 1) for setting in args.env)
+        port = free_port()
+        # one uvicorn worker is the process that handles the requests, there is no supervisor process
+        server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                                  cwd=APP_DIRECTORY, env=env)
+        try:
+            baseline, peak, duration, status_codes = asyncio.run(run(server.pid, port, image, args))
+        finally:
+            server.terminate()
+            server.wait()
+
+    errors = sum(status_code != 200 for status_code in status_codes)
+    print(f"{len(image) / 2 ** 20:.1f} MB png of {args.size}x{args.size}, {args.upload} upload, {args.concurrency} at the same time, "
+          f"{len(status_codes)} requests ({errors} errors) in {duration:.1f} s")
+    print(f"RSS when ready    {baseline / 2 ** 20:8.1f} MB")
+    print(f"peak RSS          {peak / 2 ** 20:8.1f} MB")
+    print(f"peak per upload   {(peak - baseline) / args.concurrency / 2 ** 20:8.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import httpx
+
+from load_test import APP_DIRECTORY, create_images, free_port
+from synthetic_model import create_dense_model
+
+
+# Measures the memory of one pod as the amount of gunicorn workers grows: gunicorn is started like in the docker image (uvicorn
+# workers), every worker loads the model and answers a few predictions, then the proportional memory (PSS, a shared page counts
+# for every process that maps it divided by their number) of the master and its workers is added up (linux only).
+# Every --env is a separate configuration that is measured, compare the default with the shared weights:
+#   python benchmarks/worker_memory_benchmark.py --workers 1 2 4 --env "" --env MODEL_SHARED_WEIGHTS=true
+#   python benchmarks/worker_memory_benchmark.py --workers 4 --env "MODEL_SHARED_WEIGHTS=true GUNICORN_CMD_ARGS=--preload"
+
+
+def memory(pid):
+    # the proportional and the private memory of a process in bytes
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("Pss", "Private_Clean", "Private_Dirty"):
+                values[key] = int(value.split()[0]) * 1024
+    return values["Pss"], values["Private_Clean"] + values["Private_Dirty"]
+
+
+def children(pid):
+    # the processes started by the process (the gunicorn workers of the master)
+    pids = []
+    for name in os.listdir("/proc"):
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                if name.isdigit() and int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                    pids.append(int(name))
+        except (OSError, ValueError, IndexError):
+            pass
+    return pids
+
+
+def measure(app_directory, env, workers, image, requests_per_worker=4, timeout=300):
+    # returns the PSS of the whole pod and the PSS and private memory per worker once every worker loaded the model
+    port = free_port()
+    # gunicorn also reads GUNICORN_CMD_ARGS from the environment, like --preload
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "main:app", "--worker-class", "uvicorn.workers.UvicornWorker",
+                               "--workers", str(workers), "--bind", f"127.0.0.1:{port}"],
+                              cwd=app_directory, env=env, stderr=subprocess.PIPE, text=True)
+    # every worker logs when its model is loaded (see startup_report.py)
+    loaded = set()
+    def read_log():
+        for line in server.stderr:
+            match = re.search(r"Worker (\d+) model done", line)
+            if match:
+                loaded.add(int(match.group(1)))
+    threading.Thread(target=read_log, daemon=True).start()
+    try:
+        started = time.perf_counter()
+        while len(loaded) < workers:
+            if server.poll() is not None or time.perf_counter() - started > timeout:
+                raise RuntimeError(f"Only {len(loaded)} of the {workers} workers loaded the model")
+            time.sleep(0.1)
+        # a few predictions per worker, so the memory of the inference is included
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=60) as client:
+            for _ in range(requests_per_worker * workers):
+                client.post("/lungs", files={"input_image": ("xray.png", image, "image/png")}).raise_for_status()
+        processes = [server.pid] + children(server.pid)
+        worker_memory = [memory(pid) for pid in processes[1:]]
+        total = memory(server.pid)[0] + sum(pss for pss, _ in worker_memory)
+    finally:
+        server.terminate()
+        server.wait()
+    return total, worker_memory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--app", type=str, default=APP_DIRECTORY, help="the app folder of the api that is started")
+    parser.add_argument("--model", type=str, default=None, help="an onnx model, a synthetic dense model by default")
+    parser.add_argument("--latent_dim", type=int, default=64, help="latent size of the synthetic model (64 is a model of about 80 MB, like the trained model)")
+    parser.add_argument("--env", action="append", default=None, help="api settings as space separated KEY=VALUE, once per configuration")
+    args = parser.parse_args()
+
+    image = create_images(400, 1)[0]
+    with tempfile.TemporaryDirectory() as directory:
+        model_path = os.path.abspath(args.model) if args.model else create_dense_model(os.path.join(directory, "synthetic-model.onnx"), args.latent_dim)
+        print(f"model of {os.path.getsize(model_path) / 2 ** 20:.0f} MB")
+        for configuration in args.env or [""]:
+            env = {**os.environ, "MODEL_PATH": model_path, "MODEL_SHARED_DIRECTORY": os.path.join(directory, "shared"),
+                   "PREDICTION_CACHE_MAX_BYTES": "0", "MODEL_RELOAD_INTERVAL_SECONDS": "0"}
+            env.update(setting.split("=", 1) for setting in configuration.split())
+            print(configuration or "default settings")
+            for workers in args.workers:
+                total, worker_memory = measure(os.path.abspath(args.app), env, workers, image)
+                pss = sum(pss for pss, _ in worker_memory) / len(worker_memory) / 2 ** 20
+                private = sum(private for _, private in worker_memory) / len(worker_memory) / 2 ** 20
+                print(f"  {workers} workers: pod PSS {total / 2 ** 20:7.1f} MB   per worker PSS {pss:6.1f} MB, private {private:6.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
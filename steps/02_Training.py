@@ -78,14 +78,19 @@ def prepareTraining(script_folder, compute_target, environment): # prepare train
     parameter_version = float(ENV_MODEL.get('MODEL_VERSION'))
     parameter_epochs = int(ENV_MODEL.get('MODEL_EPOCHS'))
     parameter_batchsize = int(ENV_MODEL.get('MODEL_BATCH_SIZE'))
+    parameter_arch = ENV_MODEL.get('MODEL_ARCH', 'dense') # dense or conv
     parameter_dataset_name = ENV_DATA.get('DATASET_NAME')
+    parameter_cache_dir = ENV_DATA.get('CACHE_DIR') # optional - a persistent folder for the decoded dataset
 
     # define arguments and training script for src
     args = ['--modelname', parameter_name,
             '--modelversion', parameter_version,
             '--epochs', parameter_epochs,
             '--batchsize', parameter_batchsize,
-            '--dataset_name', parameter_dataset_name]
+            '--dataset_name', parameter_dataset_name,
+            '--arch', parameter_arch]
+    if parameter_cache_dir:
+        args += ['--cache_dir', parameter_cache_dir]
     src = ScriptRunConfig(source_directory=script_folder, 
                             script=train_script_name, 
                             arguments=args,  
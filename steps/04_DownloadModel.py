@@ -46,8 +46,10 @@ def downloadModel(run, version): # download model from azure for build
     path_local = f'./{download_path}/{m}'
     path_absolute = f'{download_path_abs}/{m_absolute}'
 
-    #download model from run history/outputs
-    run.download_file(name=path_azure, output_file_path=path_local)
+    #download model from run history/outputs - next to the model and renamed once it is complete, so an api that watches
+    #the model folder never loads a half written model
+    run.download_file(name=path_azure, output_file_path=f'{path_local}.download')
+    os.replace(f'{path_local}.download', path_local)
     path_absolute = shutil.copy(path_local, path_absolute)
     print(f'Downloaded model {m} from {path_azure} on Azure to local {path_local} and absolute {path_absolute}')
     return {'path_azure':path_azure, 'path_local':path_local, 'path_absolute':path_absolute}
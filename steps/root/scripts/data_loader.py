@@ -0,0 +1,162 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+
+IMAGE_SIZE = 400
+
+
+# read one image the same way for the images and the masks: grayscale, resized to 400x400 (uint8)
+def read_image(path, size=IMAGE_SIZE):
+    return read_image_with_hash(path, size)[0]
+
+
+# the same, but also returns the sha1 of the file - the file is read once for both
+def read_image_with_hash(path, size=IMAGE_SIZE):
+    data = np.fromfile(path, dtype=np.uint8)
+    img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f'Could not read image {path}')
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (size, size)), hashlib.sha1(data).hexdigest()
+
+
+# decode all images with a pool of threads (opencv releases the GIL while decoding and resizing)
+# straight into a preallocated uint8 array - or into a memory mapped .npy file when cache_path is given.
+# A cache that was made from the same files is loaded without decoding anything.
+# keys identify the files in the cache (the file names by default), images with a key that is also in
+# previous_cache are copied from it instead of being decoded again - only new files are read.
+# hashes are the sha1 of the files (like the checksums of the manifest), with them a cache or a previous image is only
+# used when it was decoded from files with the same content
+def load_images(paths, cache_path=None, workers=None, size=IMAGE_SIZE, keys=None, previous_cache=None, hashes=None):
+    paths = list(paths)
+    keys = list(keys) if keys is not None else [os.path.basename(path) for path in paths]
+    expected_hashes = list(hashes) if hashes is not None else None
+    if cache_path is not None:
+        cached = load_cache(cache_path, keys, size, expected_hashes)
+        if cached is not None:
+            print(f'Loaded {len(paths)} images from cache {cache_path}')
+            return cached
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        # write to a temporary file first, so an interrupted run never leaves a half written cache behind
+        temporary_path = f'{cache_path}.tmp.npy'
+        images = np.lib.format.open_memmap(temporary_path, mode='w+', dtype=np.uint8, shape=(len(paths), size, size))
+    else:
+        images = np.empty((len(paths), size, size), dtype=np.uint8)
+
+    hashes = [None] * len(paths)
+    reused = reuse_images(previous_cache, keys, size, images, hashes, expected_hashes)
+
+    # every worker decodes a shard of consecutive images, so the rows of the memory mapped file are written in order
+    workers = workers or os.cpu_count()
+    shards = [shard for shard in np.array_split(np.arange(len(paths)), workers * 4) if len(shard)]
+
+    def decode(shard):
+        for index in shard:
+            if hashes[index] is None:
+                images[index], hashes[index] = read_image_with_hash(paths[index], size)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # list() raises the first error of a worker
+        list(pool.map(decode, shards))
+
+    if cache_path is not None:
+        images.flush()
+        del images
+        os.replace(temporary_path, cache_path)
+        metadata = {'paths': keys, 'hashes': hashes, 'size': size, 'content_hash': content_hash(hashes)}
+        with open(metadata_path(cache_path), 'w') as f:
+            json.dump(metadata, f)
+        print(f'Decoded {len(paths) - reused} images and reused {reused} images into cache {cache_path}')
+        return np.load(cache_path, mmap_mode='r')
+    return images
+
+
+def metadata_path(cache_path):
+    return f'{cache_path}.json'
+
+
+def read_metadata(cache_path):
+    if not os.path.exists(cache_path) or not os.path.exists(metadata_path(cache_path)):
+        return None
+    with open(metadata_path(cache_path)) as f:
+        return json.load(f)
+
+
+# returns the memory mapped cache when it was made from the same files with the same size, otherwise None.
+# With the hashes of the files the content hash of the cache has to match them too
+def load_cache(cache_path, keys, size, hashes=None):
+    metadata = read_metadata(cache_path)
+    if metadata is None or metadata.get('size') != size or metadata.get('paths') != keys:
+        return None
+    if hashes is not None and metadata.get('content_hash') != content_hash(hashes):
+        return None
+    return np.load(cache_path, mmap_mode='r')
+
+
+# copies the images that are also in the previous cache, returns the amount of copied images.
+# With the expected hashes of the files an image is only copied when its file didn't change
+def reuse_images(previous_cache, keys, size, images, hashes, expected_hashes=None):
+    metadata = read_metadata(previous_cache) if previous_cache is not None else None
+    if metadata is None or metadata.get('size') != size or 'hashes' not in metadata:
+        return 0
+    previous = np.load(previous_cache, mmap_mode='r')
+    previous_index = {key: index for index, key in enumerate(metadata['paths'])}
+    reused = 0
+    for index, key in enumerate(keys):
+        if key in previous_index and (expected_hashes is None or expected_hashes[index] == metadata['hashes'][previous_index[key]]):
+            images[index] = previous[previous_index[key]]
+            hashes[index] = metadata['hashes'][previous_index[key]]
+            reused += 1
+    return reused
+
+
+# one hash for the content of all files, in the order of the cache
+def content_hash(hashes):
+    return hashlib.sha1('\n'.join(hashes).encode()).hexdigest()
+
+
+# The cache folder of a version of a registered dataset: the name, the version and a hash of the file list
+def dataset_cache_folder(cache_dir, dataset_name, dataset_version, relative_paths):
+    listing = hashlib.sha1('\n'.join(sorted(relative_paths)).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f'{dataset_name}_v{dataset_version}_{listing}')
+
+
+# The most recent other cache folder of the same dataset, its images can be reused when only a few images were added
+def previous_dataset_cache_folder(cache_dir, dataset_name, current_folder):
+    if not os.path.isdir(cache_dir):
+        return None
+    folders = [os.path.join(cache_dir, folder) for folder in os.listdir(cache_dir)
+               if folder.startswith(f'{dataset_name}_v') and os.path.join(cache_dir, folder) != current_folder]
+    folders = [folder for folder in folders if os.path.exists(metadata_path(os.path.join(folder, 'images.npy')))]
+    return max(folders, key=os.path.getmtime, default=None)
+
+
+# A tf.data pipeline over the uint8 images and masks: only the images of one batch are gathered from the
+# (memory mapped) arrays and normalized to float32 on the fly, so there is never a float32 copy of the whole dataset
+def make_dataset(images, masks, indices, batch_size, shuffle=False, seed=42):
+    size = images.shape[1]
+    dataset = tf.data.Dataset.from_tensor_slices(np.asarray(indices, dtype=np.int64))
+    if shuffle:
+        dataset = dataset.shuffle(len(indices), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+
+    def gather(batch_indices):
+        # sorted indices read the memory mapped file in order
+        batch_indices = np.sort(batch_indices)
+        return images[batch_indices], masks[batch_indices]
+
+    def normalize(batch_images, batch_masks):
+        batch_images.set_shape((None, size, size))
+        batch_masks.set_shape((None, size, size))
+        return tf.cast(batch_images, tf.float32) / 255, tf.cast(batch_masks, tf.float32) / 255
+
+    dataset = dataset.map(lambda batch_indices: tf.numpy_function(gather, [batch_indices], [tf.uint8, tf.uint8]),
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.map(normalize, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
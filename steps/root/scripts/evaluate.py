@@ -0,0 +1,122 @@
+import os
+import json
+import argparse
+
+import numpy as np
+import onnxruntime as rt
+
+
+# Evaluation of the exported onnx model (the model the api serves) on the test pairs: dice and IoU per image and for the
+# whole test set. The images go through the model in batches and only the scores of a batch are kept, so the test set
+# can be larger than the memory.
+#   python evaluate.py outputs/model1.onnx --cache_folder cache/lungs_v1_0123456789ab --output evaluation.json
+
+
+def normalize(images):
+    return np.asarray(images, dtype=np.float32) / 255
+
+
+# the pixel counts of a batch of thresholded predictions and masks, one row per image
+def confusion_counts(predictions, masks, threshold=0.5):
+    predicted = predictions.reshape(len(predictions), -1) > threshold
+    expected = masks.reshape(len(masks), -1) > threshold
+    intersection = np.count_nonzero(predicted & expected, axis=1)
+    return intersection, np.count_nonzero(predicted, axis=1), np.count_nonzero(expected, axis=1)
+
+
+# dice and IoU of every image of a batch, an empty prediction of an empty mask scores 1
+def segmentation_scores(predictions, masks, threshold=0.5, smooth=1):
+    intersection, predicted, expected = confusion_counts(predictions, masks, threshold)
+    dice = (2 * intersection + smooth) / (predicted + expected + smooth)
+    iou = (intersection + smooth) / (predicted + expected - intersection + smooth)
+    return dice, iou
+
+
+def summarize(scores):
+    return {'mean': float(scores.mean()), 'median': float(np.median(scores)), 'min': float(scores.min()),
+            'p05': float(np.percentile(scores, 5)), 'max': float(scores.max())}
+
+
+# runs the model over the images in batches, returns the aggregate scores and the scores per image.
+# The global dice and IoU add the pixels of all images, so large and small lungs count by their size
+def evaluate_model(model_path, images, masks, batch_size=16, threshold=0.5, session=None):
+    session = session or rt.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+    input_name = session.get_inputs()[0].name
+    dice, iou = np.empty(len(images)), np.empty(len(images))
+    totals = np.zeros(3, dtype=np.int64)
+    for start in range(0, len(images), batch_size):
+        end = min(start + batch_size, len(images))
+        predictions = session.run(None, {input_name: normalize(images[start:end])})[0]
+        batch_masks = normalize(masks[start:end])
+        dice[start:end], iou[start:end] = segmentation_scores(predictions, batch_masks, threshold)
+        totals += [count.sum() for count in confusion_counts(predictions, batch_masks, threshold)]
+    intersection, predicted, expected = totals
+    return {
+        'images': len(images),
+        'threshold': threshold,
+        'dice': summarize(dice),
+        'iou': summarize(iou),
+        'global_dice': float(2 * intersection / max(predicted + expected, 1)),
+        'global_iou': float(intersection / max(predicted + expected - intersection, 1)),
+        'per_image': {'dice': dice.tolist(), 'iou': iou.tolist()},
+    }
+
+
+# logs the aggregate scores to the run, the scores per image as a list
+def log_evaluation(run, evaluation, prefix='test'):
+    for metric in ('dice', 'iou'):
+        for statistic, value in evaluation[metric].items():
+            run.log(f'{prefix} {metric} {statistic}', value)
+        run.log(f'{prefix} global {metric}', evaluation[f'global_{metric}'])
+        run.log_list(f'{prefix} {metric} per image', evaluation['per_image'][metric])
+
+
+# the rows of an array at some indices, read when a slice is asked for instead of copied up front
+class Indexed_rows:
+
+    def __init__(self, array, indices):
+        self.array = array
+        self.indices = np.asarray(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        return self.array[self.indices[index]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', type=str, help='the onnx model')
+    parser.add_argument('--cache_folder', type=str, required=True, help='a dataset cache folder of train.py (images.npy, masks.npy, manifest.json)')
+    parser.add_argument('--test_size', type=int, default=20)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--output', type=str, default=None, help='writes the evaluation as json')
+    args = parser.parse_args()
+
+    from manifest import split_manifest
+    with open(os.path.join(args.cache_folder, 'manifest.json')) as f:
+        manifest = json.load(f)['pairs']
+    images = np.load(os.path.join(args.cache_folder, 'images.npy'), mmap_mode='r')
+    masks = np.load(os.path.join(args.cache_folder, 'masks.npy'), mmap_mode='r')
+    # the same split as train.py, the rows are read from the memory mapped cache one batch at a time
+    _, test_indices = split_manifest(manifest, args.test_size, seed=42)
+    evaluation = evaluate_model(args.model, Indexed_rows(images, test_indices), Indexed_rows(masks, test_indices),
+                                args.batch_size, args.threshold)
+    evaluation['stems'] = [manifest[index]['stem'] for index in test_indices]
+    print(json.dumps({key: value for key, value in evaluation.items() if key not in ('per_image', 'stems')}, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(evaluation, f, indent=2)
+    # logged to the run when azureml is installed (an offline run only prints), a local evaluation only prints
+    try:
+        from azureml.core import Run
+    except ImportError:
+        return
+    log_evaluation(Run.get_context(), evaluation)
+
+
+if __name__ == '__main__':
+    main()
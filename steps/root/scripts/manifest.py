@@ -0,0 +1,110 @@
+import os
+import json
+import struct
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+# The name that an image and its mask have in common: the file name without extensions and without the
+# "_mask" suffix of the masks (CHN_0001.png and CHN_0001_mask.png -> chn_0001)
+def pair_stem(key):
+    name = os.path.basename(key.rstrip('/')).split('.')[0].lower()
+    for suffix in ('_mask', '-mask', 'mask'):
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+# pairs images and masks by stem instead of by position. Returns the pairs (sorted by stem) and the files that
+# were rejected: images without a mask, masks without an image and stems that are in the dataset twice
+def pair_images(image_keys, mask_keys):
+    images, masks, rejected = {}, {}, []
+    for keys, found, kind in ((image_keys, images, 'image'), (mask_keys, masks, 'mask')):
+        for key in keys:
+            stem = pair_stem(key)
+            if stem in found:
+                rejected.append({'stem': stem, 'file': key, 'reason': f'duplicate {kind}'})
+                continue
+            found[stem] = key
+    for stem in sorted(images.keys() - masks.keys()):
+        rejected.append({'stem': stem, 'file': images[stem], 'reason': 'image without mask'})
+    for stem in sorted(masks.keys() - images.keys()):
+        rejected.append({'stem': stem, 'file': masks[stem], 'reason': 'mask without image'})
+    pairs = [{'stem': stem, 'image': images[stem], 'mask': masks[stem]} for stem in sorted(images.keys() & masks.keys())]
+    return pairs, rejected
+
+
+# width and height of a png from its header, other formats are decoded
+def image_shape(data):
+    if data[:8] == PNG_SIGNATURE and data[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', data[16:24])
+        return [height, width]
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError('not an image')
+    return list(image.shape[:2])
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return hashlib.sha1(data).hexdigest(), image_shape(data)
+
+
+# reads every pair in parallel and records the checksum and the shape of the image and the mask.
+# A pair is rejected when a file can't be read or when the image and the mask don't have the same shape.
+# Returns the manifest (the valid pairs, in the same order) and the rejected pairs
+def validate_pairs(pairs, root, workers=None):
+    def validate(pair):
+        try:
+            image_sha1, image_shape = read_file(os.path.join(root, pair['image'].lstrip('/')))
+            mask_sha1, mask_shape = read_file(os.path.join(root, pair['mask'].lstrip('/')))
+        except (OSError, ValueError) as e:
+            return {**pair, 'reason': f'unreadable: {e}'}
+        if image_shape != mask_shape:
+            return {**pair, 'reason': f'shape of image {image_shape} and mask {mask_shape} differ'}
+        return {**pair, 'shape': image_shape, 'image_sha1': image_sha1, 'mask_sha1': mask_sha1}
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        checked = list(pool.map(validate, pairs))
+    manifest = [pair for pair in checked if 'reason' not in pair]
+    rejected = [pair for pair in checked if 'reason' in pair]
+    return manifest, rejected
+
+
+# the manifest and the rejected pairs are saved together, so a next run knows why pairs are missing
+def save_manifest(path, manifest, rejected):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump({'pairs': manifest, 'rejected': rejected}, f)
+    os.replace(f'{path}.tmp', path)
+
+
+# the saved manifest and rejected pairs when they were made from the same pairs, otherwise None
+def load_manifest(path, pairs):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        saved = json.load(f)
+    files = {(pair['image'], pair['mask']) for pair in pairs}
+    checked = [(pair['image'], pair['mask']) for pair in saved['pairs'] + saved['rejected'] if 'mask' in pair]
+    if len(checked) != len(files) or set(checked) != files:
+        return None
+    return saved['pairs'], saved['rejected']
+
+
+# a split that only depends on the stems and the seed, not on the order of the files or the other pairs:
+# the test set is made of the pairs with the lowest hash of seed + stem
+def split_manifest(manifest, test_size, seed=42):
+    if isinstance(test_size, float):
+        test_size = int(round(len(manifest) * test_size))
+    ranks = sorted(range(len(manifest)), key=lambda index: hashlib.sha1(f'{seed}:{manifest[index]["stem"]}'.encode()).hexdigest())
+    test_indices = np.sort(np.asarray(ranks[:test_size], dtype=np.int64))
+    train_indices = np.sort(np.asarray(ranks[test_size:], dtype=np.int64))
+    return train_indices, test_indices
@@ -0,0 +1,87 @@
+import tensorflow as tf
+from tensorflow.keras import layers
+from tensorflow.keras.models import Model
+from tensorflow.keras import backend as K
+
+
+IMAGE_SIZE = 400
+
+
+# the loss of both architectures
+class Segmentation_model(Model):
+
+  def dice_coef(self, y_true, y_pred, smooth=1):
+    intersection = K.sum(K.abs(y_true * y_pred), axis=-1)
+    return (2.*intersection + smooth)/(K.sum(K.square(y_true),-1)+ K.sum(K.square(y_pred),-1) + smooth)
+
+  def dice_coef_loss(self, y_true, y_pred):
+    return 1-self.dice_coef(y_true, y_pred)
+
+
+# Flatten -> Dense(64) -> Dense(400*400): two 160000x64 weight matrices, about 20M parameters
+class Autoencoder(Segmentation_model):
+  def __init__(self, latent_dim):
+    super(Autoencoder, self).__init__()
+    self.latent_dim = latent_dim   
+    self.encoder = tf.keras.Sequential([
+      layers.Flatten(),
+      layers.Dense(latent_dim, activation='relu'),
+    ])
+    self.decoder = tf.keras.Sequential([
+      layers.Dense(IMAGE_SIZE*IMAGE_SIZE, activation='sigmoid'),
+      layers.Reshape((IMAGE_SIZE, IMAGE_SIZE))
+    ])
+
+  def call(self, x):
+    encoded = self.encoder(x)
+    decoded = self.decoder(encoded)
+    return decoded
+
+
+# A small U-Net: a 4x4 patch stem (400x400 -> 100x100), 3x3 convolutions with max pooling on the way down and
+# upsampling + the features of the same resolution (skip connections) on the way up, the logits of the mask are
+# upsampled bilinearly to 400x400. The same input and output as the Autoencoder (a batch of 400x400 images),
+# with a few ten thousand parameters instead of 20M
+class Conv_autoencoder(Segmentation_model):
+  def __init__(self, filters=(8, 16, 32), stem_stride=4):
+    super(Conv_autoencoder, self).__init__()
+    self.filters = filters
+    self.to_channels = layers.Reshape((IMAGE_SIZE, IMAGE_SIZE, 1))
+    self.stem = layers.Conv2D(filters[0], stem_stride, strides=stem_stride, activation='relu')
+    self.down = [self.conv_block(f) for f in filters[:-1]]
+    self.pool = [layers.MaxPooling2D(2) for _ in filters[:-1]]
+    self.bottleneck = self.conv_block(filters[-1])
+    self.upsample = [layers.UpSampling2D(2) for _ in filters[:-1]]
+    self.concatenate = [layers.Concatenate() for _ in filters[:-1]]
+    self.up = [self.conv_block(f) for f in reversed(filters[:-1])]
+    self.segmentation = layers.Conv2D(1, 1)
+    self.to_full_size = layers.UpSampling2D(stem_stride, interpolation='bilinear')
+    self.probabilities = layers.Activation('sigmoid')
+    self.to_image = layers.Reshape((IMAGE_SIZE, IMAGE_SIZE))
+
+  def conv_block(self, filters):
+    return tf.keras.Sequential([
+      layers.Conv2D(filters, 3, padding='same', activation='relu'),
+      layers.Conv2D(filters, 3, padding='same', activation='relu'),
+    ])
+
+  def call(self, x):
+    x = self.stem(self.to_channels(x))
+    skips = []
+    for down, pool in zip(self.down, self.pool):
+      x = down(x)
+      skips.append(x)
+      x = pool(x)
+    x = self.bottleneck(x)
+    for upsample, concatenate, up, skip in zip(self.upsample, self.concatenate, self.up, reversed(skips)):
+      x = up(concatenate([upsample(x), skip]))
+    return self.to_image(self.probabilities(self.to_full_size(self.segmentation(x))))
+
+
+ARCHITECTURES = ['dense', 'conv']
+
+
+def create_model(arch, latent_dim=64):
+  if arch == 'conv':
+    return Conv_autoencoder()
+  return Autoencoder(latent_dim)
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import onnxruntime as rt
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+from evaluate import Indexed_rows, evaluate_model, normalize
+
+
+# Optimization of the exported onnx model: every variant (graph optimized, int8 dynamic, int8 static, fp16) is compared with
+# the fp32 model on the test images - file size, cpu latency and dice - and the fastest variant whose dice stays within the
+# tolerance replaces the model that is registered.
+#   python optimize.py outputs/model1.onnx --cache_folder cache/lungs_v1_0123456789ab --tolerance 0.01
+
+
+VARIANTS = ['fp32', 'optimized', 'int8_dynamic', 'int8_static', 'fp16']
+
+
+# the onnxruntime graph optimizations that don't depend on the cpu, done once here instead of every time the api loads the model
+def optimize_graph(model_path, output_path):
+    options = rt.SessionOptions()
+    options.graph_optimization_level = rt.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    options.optimized_model_filepath = output_path
+    rt.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+    return output_path
+
+
+# int8 weights, the activations are quantized on the fly
+def quantize_int8_dynamic(model_path, output_path):
+    quantize_dynamic(model_path, output_path, weight_type=QuantType.QInt8)
+    return output_path
+
+
+# feeds the calibration images in batches to the quantizer
+class Calibration_reader(CalibrationDataReader):
+
+    def __init__(self, input_name, images, batch_size=8):
+        self.batches = iter([{input_name: normalize(images[i:i + batch_size])} for i in range(0, len(images), batch_size)])
+
+    def get_next(self):
+        return next(self.batches, None)
+
+
+# int8 weights and activations, the ranges of the activations are calibrated on a sample of lung images
+def quantize_int8_static(model_path, output_path, calibration_images):
+    input_name = rt.InferenceSession(model_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+    quantize_static(model_path, output_path, Calibration_reader(input_name, calibration_images),
+                    quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    return output_path
+
+
+# fp16 weights and compute, the input and output stay float32 so the api doesn't change
+def convert_fp16(model_path, output_path):
+    import onnx
+    from onnxconverter_common import float16
+    model = float16.convert_float_to_float16(onnx.load(model_path), keep_io_types=True)
+    onnx.save(model, output_path)
+    return output_path
+
+
+# file size, latency of one batch and the mean dice on the test images
+def evaluate(model_path, images, masks, batch_size=8, repeat=5):
+    session = rt.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+    input_name = session.get_inputs()[0].name
+    evaluation = evaluate_model(model_path, images, masks, batch_size, session=session)
+    batch = normalize(images[:batch_size])
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        session.run(None, {input_name: batch})
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {'size_mb': os.path.getsize(model_path) / 2 ** 20,
+            'latency_ms': float(np.median(latencies)),
+            'dice': evaluation['dice']['mean']}
+
+
+# a random (but always the same) sample of the training images for the calibration
+def calibration_sample(train_indices, size, seed=42):
+    size = min(size, len(train_indices))
+    return np.sort(np.random.default_rng(seed).choice(train_indices, size, replace=False))
+
+
+def create_variant(variant, model_path, output_path, calibration_images):
+    if variant == 'fp32':
+        return model_path
+    if variant == 'optimized':
+        return optimize_graph(model_path, output_path)
+    if variant == 'int8_dynamic':
+        return quantize_int8_dynamic(model_path, output_path)
+    if variant == 'int8_static':
+        return quantize_int8_static(model_path, output_path, calibration_images)
+    return convert_fp16(model_path, output_path)
+
+
+# makes and evaluates every variant and replaces model_path by the fastest variant within the tolerance of the fp32 dice.
+# Returns the report, a variant that can't be made (an operator the quantizer doesn't support) is reported and skipped
+def optimize_model(model_path, images, masks, calibration_images, tolerance=0.01, variants=VARIANTS):
+    report = {'tolerance': tolerance, 'variants': {}}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {}
+        for variant in ['fp32'] + [variant for variant in variants if variant != 'fp32']:
+            try:
+                paths[variant] = create_variant(variant, model_path, os.path.join(directory, f'{variant}.onnx'), calibration_images)
+                report['variants'][variant] = evaluate(paths[variant], images, masks)
+            except Exception as e:
+                report['variants'][variant] = {'error': f'{type(e).__name__}: {e}'}
+            print(variant, report['variants'][variant])
+
+        baseline = report['variants']['fp32']['dice']
+        accepted = [variant for variant, result in report['variants'].items()
+                    if 'error' not in result and baseline - result['dice'] <= tolerance]
+        for variant in report['variants']:
+            report['variants'][variant]['accepted'] = variant in accepted
+        report['selected'] = min(accepted, key=lambda variant: report['variants'][variant]['latency_ms'])
+        if report['selected'] != 'fp32':
+            shutil.copyfile(paths[report['selected']], model_path)
+    print('Selected', report['selected'])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', type=str, help='the onnx model, it is replaced by the selected variant')
+    parser.add_argument('--cache_folder', type=str, required=True, help='a dataset cache folder of train.py (images.npy, masks.npy, manifest.json)')
+    parser.add_argument('--test_size', type=int, default=20)
+    parser.add_argument('--calibration_size', type=int, default=64)
+    parser.add_argument('--tolerance', type=float, default=0.01, help='the largest drop of the dice that is accepted')
+    parser.add_argument('--variants', type=str, nargs='+', default=VARIANTS, choices=VARIANTS)
+    parser.add_argument('--report', type=str, default=None, help='writes the report as json')
+    args = parser.parse_args()
+
+    from manifest import split_manifest
+    with open(os.path.join(args.cache_folder, 'manifest.json')) as f:
+        manifest = json.load(f)['pairs']
+    images = np.load(os.path.join(args.cache_folder, 'images.npy'), mmap_mode='r')
+    masks = np.load(os.path.join(args.cache_folder, 'masks.npy'), mmap_mode='r')
+    # the same split as train.py
+    train_indices, test_indices = split_manifest(manifest, args.test_size, seed=42)
+    calibration_indices = calibration_sample(train_indices, args.calibration_size)
+    report = optimize_model(args.model, Indexed_rows(images, test_indices), Indexed_rows(masks, test_indices), images[calibration_indices],
+                            args.tolerance, args.variants)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,254 @@
+import os
+import sys
 import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import cv2
 import numpy as np
-import os
-import pickle
-import joblib
+import onnxruntime as rt
+
+
+# Offline batch scoring of x-rays with the exported onnx model: every image of a folder (or of a manifest of train.py) is
+# decoded, predicted in batches and its mask is written as a png next to the same relative path in the output folder.
+# Locally the batches are spread over a pool of processes that each load the model once, every scored image is appended
+# to a checkpoint so an interrupted job resumes where it stopped:
+#   python score.py /data/xrays --model lung-model.onnx --output_dir masks --workers 4
+#   python score.py cache/lungs_v1_0123456789ab/manifest.json --root /data/lungs --model lung-model.onnx --output_dir masks
+# In azure ml the same file is the entry script of a ParallelRunStep: init() loads the model of AZUREML_MODEL_DIR once per
+# process and run(mini_batch) scores a list of files and returns one json row per image, the masks keep the folders of the files
+# below --root (the mount path of the input dataset)
+
+
+IMAGE_SIZE = 400
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+CHECKPOINT_FILE = 'scored.jsonl'
+SUMMARY_FILE = 'summary.json'
+
+# the model and options of this process, set by load_model (init in azure ml, the initializer of a pool process locally)
+session = None
+options = None
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default=None, help='the onnx model, lung-model.onnx in AZUREML_MODEL_DIR by default')
+    parser.add_argument('--output_dir', type=str, default='outputs/masks')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--mask_size', type=str, default='original', choices=['original', 'model'],
+                        help='original resizes the mask back to the size of the x-ray, model keeps the 400x400 mask')
+    parser.add_argument('--threads', type=int, default=0, help='onnxruntime threads per process, 0 lets onnxruntime decide')
+    parser.add_argument('--root', type=str, default=None,
+                        help='the folder the paths of a manifest, or the files of an azure ml mini batch (the mount path of the input dataset), are relative to')
+    return parser
+
+
+def find_model(model_path=None):
+    if model_path:
+        return model_path
+    model_dir = os.getenv('AZUREML_MODEL_DIR', '.')
+    default_path = os.path.join(model_dir, 'lung-model.onnx')
+    if os.path.exists(default_path):
+        return default_path
+    # a registered model keeps the file name of the run, like model1.onnx
+    models = sorted(name for name in os.listdir(model_dir) if name.endswith('.onnx'))
+    if not models:
+        raise FileNotFoundError(f'No onnx model in {model_dir}')
+    return os.path.join(model_dir, models[0])
+
+
+# loads the model once per process, the options are the parsed arguments of create_parser
+def load_model(model_path, score_options):
+    global session, options
+    session_options = rt.SessionOptions()
+    session_options.intra_op_num_threads = score_options.threads
+    session = rt.InferenceSession(model_path, session_options, providers=['CPUExecutionProvider'])
+    options = score_options
+
+
+# decoded the same way as read_image in data_loader.py: grayscale and resized to 400x400 (uint8), also returns the
+# height and width of the x-ray
+def read_xray(path):
+    img = cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError('not an image')
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (IMAGE_SIZE, IMAGE_SIZE)), gray.shape
+
+
+def mask_path(output_dir, relative_path):
+    return os.path.join(output_dir, os.path.splitext(relative_path)[0] + '_mask.png')
+
+
+# the mask of one prediction: resized back to the x-ray (the probabilities, so the edges stay smooth) and thresholded
+def write_mask(path, prediction, shape):
+    probabilities = prediction.reshape(IMAGE_SIZE, IMAGE_SIZE)
+    if options.mask_size == 'original' and shape != probabilities.shape:
+        probabilities = cv2.resize(probabilities, (shape[1], shape[0]), interpolation=cv2.INTER_LINEAR)
+    mask = (probabilities > options.threshold).astype(np.uint8) * 255
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    succeeded, buffer = cv2.imencode('.png', mask)
+    if not succeeded:
+        raise ValueError(f'Could not encode the mask {path}')
+    buffer.tofile(path)
+    return float(np.count_nonzero(mask)) / mask.size
 
+
+# scores a list of (path, relative path) pairs with the model of this process: the images are decoded into one batch,
+# predicted per batch_size images and the masks are written. Returns one record per image, an image that can't be read
+# gets an error instead of stopping the batch
+def score_files(files, output_dir):
+    records = []
+    for start in range(0, len(files), options.batch_size):
+        chunk = files[start:start + options.batch_size]
+        images = np.empty((len(chunk), IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32)
+        decoded = []
+        for path, relative_path in chunk:
+            try:
+                image, shape = read_xray(path)
+            except (OSError, ValueError) as e:
+                records.append({'image': relative_path, 'error': str(e)})
+                continue
+            np.divide(image, 255, out=images[len(decoded)], dtype=np.float32)
+            decoded.append((relative_path, shape))
+        if not decoded:
+            continue
+        predictions = session.run(None, {session.get_inputs()[0].name: images[:len(decoded)]})[0]
+        for prediction, (relative_path, shape) in zip(predictions, decoded):
+            output_path = mask_path(output_dir, relative_path)
+            try:
+                lung_fraction = write_mask(output_path, prediction, shape)
+            except (OSError, ValueError) as e:
+                records.append({'image': relative_path, 'error': str(e)})
+                continue
+            records.append({'image': relative_path, 'mask': os.path.relpath(output_path, output_dir),
+                            'shape': list(shape), 'lung_fraction': round(lung_fraction, 4)})
+    return records
+
+
+# azure ml ParallelRunStep: called once per process before the first mini batch, the arguments of the step are in sys.argv
 def init():
-    global model
-    # AZUREML_MODEL_DIR is an environment variable created during deployment.
-    # It is the path to the model folder (./azureml-models/$MODEL_NAME/$VERSION)
-    # For multiple models, it points to the folder containing all deployed models (./azureml-models)
-    model_path = os.path.join(os.getenv('AZUREML_MODEL_DIR'), 'sklearn_mnist_model.pkl')
-    model = joblib.load(model_path)
-
-def run(raw_data):
-    data = np.array(json.loads(raw_data)['data'])
-    # make prediction
-    y_hat = model.predict(data)
-    # you can return any data type as long as it is JSON-serializable
-    return y_hat.tolist()
\ No newline at end of file
+    score_options, _ = create_parser().parse_known_args()
+    load_model(find_model(score_options.model), score_options)
+    os.makedirs(score_options.output_dir, exist_ok=True)
+
+
+# azure ml ParallelRunStep: scores the files of one mini batch, returns one json row per image (append_row writes them to one file)
+def run(mini_batch):
+    files = [(path, input_relative_path(path, options.root)) for path in mini_batch]
+    return [json.dumps(record) for record in score_files(files, options.output_dir)]
+
+
+# The path of a file of a mini batch relative to the root of the input, like list_images does locally, so x-rays with the same
+# name in different folders (one folder per patient) get their own mask. The mini batches of one job are spread over nodes and
+# processes, so without --root the whole path is kept instead of a root that would differ per mini batch
+def input_relative_path(path, root=None):
+    path = os.path.abspath(path)
+    if root is not None:
+        relative_path = os.path.relpath(path, os.path.abspath(root))
+        if not relative_path.startswith(os.pardir):
+            return relative_path
+    return os.path.splitdrive(path)[1].lstrip(os.sep)
+
+
+# the images to score as (path, relative path) pairs: every image of a folder tree or the images of a manifest.json of train.py
+def list_images(source, root=None):
+    if source.endswith('.json'):
+        with open(source) as f:
+            pairs = json.load(f)['pairs']
+        root = root or os.path.dirname(os.path.abspath(source))
+        relative_paths = [pair['image'].lstrip('/') for pair in pairs]
+    else:
+        root = source
+        relative_paths = []
+        for directory, _, file_names in os.walk(source):
+            for file_name in file_names:
+                if file_name.lower().endswith(IMAGE_EXTENSIONS) and not os.path.splitext(file_name)[0].lower().endswith('mask'):
+                    relative_paths.append(os.path.relpath(os.path.join(directory, file_name), source))
+    return [(os.path.join(root, relative_path), relative_path) for relative_path in sorted(relative_paths)]
+
+
+# the images that were scored by an earlier run, a line that was cut off by an interrupted run is ignored.
+# Images that failed are not in the set, so they are tried again
+def read_checkpoint(checkpoint_path):
+    scored = set()
+    if not os.path.exists(checkpoint_path):
+        return scored
+    with open(checkpoint_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if 'error' not in record:
+                scored.add(record['image'])
+    return scored
+
+
+# scores the images with a pool of processes: every process loads the model once and scores whole chunks (decode, batched
+# inference and writing the masks), so the processes decode, predict and write at the same time. Only a few chunks per
+# process are submitted at once, so the pending work stays small for any amount of images
+def score_folder(files, output_dir, model_path, score_options, workers, chunk_size, resume=True, progress_seconds=10):
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
+    scored = read_checkpoint(checkpoint_path) if resume else set()
+    todo = [(path, relative_path) for path, relative_path in files if relative_path not in scored]
+    print(f'{len(files)} images, {len(files) - len(todo)} already scored, {len(todo)} to score with {workers} processes')
+
+    chunks = iter([todo[start:start + chunk_size] for start in range(0, len(todo), chunk_size)])
+    counts = {'scored': 0, 'failed': 0}
+    started = last_progress = time.perf_counter()
+    with open(checkpoint_path, 'a' if resume else 'w') as checkpoint, \
+            ProcessPoolExecutor(max_workers=workers, initializer=load_model, initargs=(model_path, score_options)) as pool:
+        pending = set()
+        while True:
+            while len(pending) < workers * 2:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.add(pool.submit(score_files, chunk, output_dir))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for record in future.result():
+                    counts['failed' if 'error' in record else 'scored'] += 1
+                    checkpoint.write(json.dumps(record) + '\n')
+            # the masks of these records are written, a resumed run skips them
+            checkpoint.flush()
+            if time.perf_counter() - last_progress >= progress_seconds:
+                last_progress = time.perf_counter()
+                done_count = counts['scored'] + counts['failed']
+                print(f'{done_count}/{len(todo)} images, {done_count / (last_progress - started):.1f} images/sec')
+
+    seconds = time.perf_counter() - started
+    summary = {'images': len(files), 'skipped': len(files) - len(todo), **counts, 'seconds': round(seconds, 2),
+               'images_per_second': round((counts['scored'] + counts['failed']) / seconds, 2) if seconds else 0.0,
+               'workers': workers, 'batch_size': score_options.batch_size}
+    with open(os.path.join(output_dir, SUMMARY_FILE), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main():
+    parser = create_parser()
+    parser.add_argument('source', type=str, help='a folder of x-rays or a manifest.json of train.py')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk_size', type=int, default=64, help='the images a process scores before it reports them to the checkpoint')
+    parser.add_argument('--restart', action='store_true', help='scores all images again instead of resuming from the checkpoint')
+    args = parser.parse_args()
+    if not args.threads:
+        # the processes share the cores instead of every session starting a thread per core
+        args.threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    files = list_images(args.source, args.root)
+    summary = score_folder(files, args.output_dir, find_model(args.model), args, args.workers, args.chunk_size, resume=not args.restart)
+    print(json.dumps(summary, indent=2))
+    if summary['failed']:
+        print(f'{summary["failed"]} images could not be scored, see {os.path.join(args.output_dir, CHECKPOINT_FILE)}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
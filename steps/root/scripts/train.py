@@ -1,8 +1,10 @@
 
 import argparse
 import os
+import json
 import numpy as np
 import glob
+import fnmatch
 import cv2 
 import random
 import joblib
@@ -11,14 +13,16 @@ os.environ["KERAS_BACKEND"] = "tensorflow"
 import tensorflow as tf
 import onnxmltools
 import tf2onnx
-from sklearn.model_selection import train_test_split
 
-from tensorflow.keras import layers, losses
-from tensorflow.keras.models import Model
-from tensorflow.keras import backend as K
 
 from azureml.core import Workspace, Dataset, Run
 
+from data_loader import IMAGE_SIZE, load_images, load_cache, make_dataset, dataset_cache_folder, previous_dataset_cache_folder
+from manifest import pair_images, validate_pairs, save_manifest, load_manifest, split_manifest
+from models import ARCHITECTURES, create_model
+from optimize import optimize_model, calibration_sample
+from evaluate import Indexed_rows, evaluate_model, log_evaluation
+
 # arguments - given during training step 02
 parser = argparse.ArgumentParser()
 parser.add_argument('--modelname', type=str, dest='modelname', default="model1")
@@ -26,6 +30,17 @@ parser.add_argument('--modelversion', type=float, dest='modelversion', default=0
 parser.add_argument('--epochs', type=int, dest='epochs', default=20)
 parser.add_argument('--batchsize', type=int, dest='batchsize', default=64)
 parser.add_argument('--dataset_name', type=str, dest='dataset_name', default='lungs')
+# point the cache folder to a persistent disk or mounted datastore to reuse the decoded dataset between runs
+parser.add_argument('--cache_dir', type=str, dest='cache_dir', default=os.path.join(os.getcwd(), 'cache'))
+parser.add_argument('--workers', type=int, dest='workers', default=os.cpu_count())
+parser.add_argument('--data_access', type=str, dest='data_access', default='mount', choices=['mount', 'download'])
+parser.add_argument('--test_size', type=int, dest='test_size', default=20)
+# dense: the Flatten-Dense autoencoder (about 20M parameters), conv: a small U-Net with the same input and output
+parser.add_argument('--arch', type=str, dest='arch', default='dense', choices=ARCHITECTURES)
+# graph optimization and int8/fp16 quantization of the onnx model, a variant is only used when its dice drops less than the tolerance
+parser.add_argument('--optimize', type=str, dest='optimize', default='true', choices=['true', 'false'])
+parser.add_argument('--optimize_tolerance', type=float, dest='optimize_tolerance', default=0.01)
+parser.add_argument('--calibration_size', type=int, dest='calibration_size', default=64)
 args = parser.parse_args()
 
 # data inlezen
@@ -38,76 +53,110 @@ run = Run.get_context()
 workspace = run.experiment.workspace
 
 dataset = Dataset.get_by_name(workspace, name=args.dataset_name)
-dataset.download(target_path=dataset_folder, overwrite=True)
-
-# reading images
-Lung_images_path = glob.glob('./dataset/Lung_images/*.png') 
-Lung_masks_path = glob.glob('./dataset/Lung_masks/*.png*') 
-
-def read_images(path):
-    images = []
-    for f in path: 
-        img = cv2.imread(f) 
-        im_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        resize = cv2.resize(im_rgb, (400,400))
-        images.append(resize) 
-    return images
-
-X = np.array(read_images(Lung_images_path)) # images
-y = np.array(read_images(Lung_masks_path)) # masks
 
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=20, random_state=42)
-
-print(X_train.shape, y_train.shape, X_test.shape, y_test.shape, sep = '\n')
-
-# normalisatie van de pixel waarden
-X_train = X_train.astype('float32') / 255
-X_test = X_test.astype('float32') / 255
-y_train = y_train.astype('float32') / 255
-y_test = y_test.astype('float32') / 255
+# reading images - the file list of the dataset is known without downloading it
+relative_paths = dataset.to_path()
+Lung_images_keys = sorted(p for p in relative_paths if fnmatch.fnmatch(p.lstrip('/'), 'Lung_images/*.png'))
+Lung_masks_keys = sorted(p for p in relative_paths if fnmatch.fnmatch(p.lstrip('/'), 'Lung_masks/*.png*'))
+
+# images and masks are paired by name (CHN_0001.png - CHN_0001_mask.png), not by their position in the listing
+pairs, unpaired = pair_images(Lung_images_keys, Lung_masks_keys)
+
+# the decoded images are cached per dataset version, files of an older version that are still in this version are reused
+# (an image is only reused when its checksum in the manifest is the checksum it was decoded from)
+cache_folder = dataset_cache_folder(args.cache_dir, args.dataset_name, dataset.version, relative_paths)
+previous_cache_folder = previous_dataset_cache_folder(args.cache_dir, args.dataset_name, cache_folder)
+images_cache = os.path.join(cache_folder, 'images.npy')
+masks_cache = os.path.join(cache_folder, 'masks.npy')
+manifest_path = os.path.join(cache_folder, 'manifest.json')
+print('Cache folder:', cache_folder, 'previous cache folder:', previous_cache_folder)
+
+def read_dataset(root, checked=None):
+    # every pair is checked (readable, same shape) and gets a checksum, the manifest is the input of the decoding
+    manifest, rejected = checked or validate_pairs(pairs, root, workers=args.workers)
+    save_manifest(manifest_path, manifest, rejected)
+    # decoded in parallel into uint8 .npy files in the cache folder, only the images that aren't cached yet are read
+    def previous(name):
+        return os.path.join(previous_cache_folder, name) if previous_cache_folder else None
+    images_keys = [pair['image'] for pair in manifest]
+    masks_keys = [pair['mask'] for pair in manifest]
+    # the checksums of the manifest are the content hash of the cache, a cache of files that changed is decoded again
+    X = load_images([os.path.join(root, p.lstrip('/')) for p in images_keys], images_cache, workers=args.workers,
+                    keys=images_keys, previous_cache=previous('images.npy'), hashes=[pair['image_sha1'] for pair in manifest]) # images
+    y = load_images([os.path.join(root, p.lstrip('/')) for p in masks_keys], masks_cache, workers=args.workers,
+                    keys=masks_keys, previous_cache=previous('masks.npy'), hashes=[pair['mask_sha1'] for pair in manifest]) # masks
+    return manifest, rejected, X, y
+
+checked = load_manifest(manifest_path, pairs)
+if checked is not None and load_cache(images_cache, [pair['image'] for pair in checked[0]], IMAGE_SIZE, [pair['image_sha1'] for pair in checked[0]]) is not None \
+        and load_cache(masks_cache, [pair['mask'] for pair in checked[0]], IMAGE_SIZE, [pair['mask_sha1'] for pair in checked[0]]) is not None:
+    # everything is cached, the dataset doesn't have to be downloaded or mounted
+    manifest, rejected, X, y = read_dataset(dataset_folder, checked)
+elif args.data_access == 'mount':
+    # a mounted dataset only reads the files that are opened
+    with dataset.mount() as mount_context:
+        manifest, rejected, X, y = read_dataset(mount_context.mount_point)
+else:
+    dataset.download(target_path=dataset_folder, overwrite=True)
+    manifest, rejected, X, y = read_dataset(dataset_folder)
+
+# the rejected files are left out of the training, but never silently
+rejected = unpaired + rejected
+for pair in rejected:
+    print('Rejected', pair.get('file') or f"{pair['image']} - {pair['mask']}", ':', pair['reason'])
+print(f'{len(manifest)} pairs of images and masks, {len(rejected)} rejected')
+
+# split the indices of the manifest instead of the images, the split only depends on the names of the pairs
+train_indices, test_indices = split_manifest(manifest, args.test_size, seed=42)
+
+print(X.shape, y.shape, len(train_indices), len(test_indices), sep = '\n')
+
+# normalisatie van de pixel waarden - happens per batch in the tf.data pipeline
+train_dataset = make_dataset(X, y, train_indices, args.batchsize, shuffle=True)
 
 # Creating autoencoder model
 latent_dim = 64 
 
-class Autoencoder(Model):
-  def __init__(self, latent_dim):
-    super(Autoencoder, self).__init__()
-    self.latent_dim = latent_dim   
-    self.encoder = tf.keras.Sequential([
-      layers.Flatten(),
-      layers.Dense(latent_dim, activation='relu'),
-    ])
-    self.decoder = tf.keras.Sequential([
-      layers.Dense(400*400, activation='sigmoid'),
-      layers.Reshape((400, 400))
-    ])
-
-  def call(self, x):
-    encoded = self.encoder(x)
-    decoded = self.decoder(encoded)
-    return decoded
-
-  def dice_coef(self, y_true, y_pred, smooth=1):
-    intersection = K.sum(K.abs(y_true * y_pred), axis=-1)
-    return (2.*intersection + smooth)/(K.sum(K.square(y_true),-1)+ K.sum(K.square(y_pred),-1) + smooth)
-
-  def dice_coef_loss(self, y_true, y_pred):
-    return 1-self.dice_coef(y_true, y_pred)
-
-autoencoder = Autoencoder(latent_dim)
+autoencoder = create_model(args.arch, latent_dim)
 
 autoencoder.compile(optimizer='adam', loss=autoencoder.dice_coef_loss)
-history = autoencoder.fit(X_train, y_train, epochs=args.epochs, batch_size=args.batchsize, shuffle=True)
+history = autoencoder.fit(train_dataset, epochs=args.epochs)
 
-print("Train an autoencoder with batchsize {}; epochs: {}".format(args.batchsize, args.epochs))
+print("Train an autoencoder ({}, {} parameters) with batchsize {}; epochs: {}".format(args.arch, autoencoder.count_params(), args.batchsize, args.epochs))
 
 # Showing loss
 print("loss training: {}".format(history.history['loss']))
 
 # adding logs
+run.log('dataset version', dataset.version)
+run.log('pairs', len(manifest))
+run.log('rejected pairs', len(rejected))
+run.log('architecture', args.arch)
+run.log('parameters', autoencoder.count_params())
 run.log('batch size', np.int(args.batchsize))
 run.log('epochs', np.int(args.epochs))
 
 os.makedirs('outputs', exist_ok=True)
 onnx_model = onnxmltools.convert_keras(autoencoder) 
 onnxmltools.utils.save_model(onnx_model, f'outputs/{args.modelname}.onnx')
+
+if args.optimize == 'true':
+    # the test images decide which variant is registered, a sample of the training images calibrates the static quantization
+    calibration_indices = calibration_sample(train_indices, args.calibration_size)
+    report = optimize_model(f'outputs/{args.modelname}.onnx', Indexed_rows(X, test_indices), Indexed_rows(y, test_indices), X[calibration_indices],
+                            tolerance=args.optimize_tolerance)
+    with open('outputs/optimization.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    for variant, result in report['variants'].items():
+        for metric in ('size_mb', 'latency_ms', 'dice'):
+            if metric in result:
+                run.log(f'{variant} {metric}', result[metric])
+    run.log('selected variant', report['selected'])
+
+# evaluation of the onnx model that is registered (the model the api serves) on the test images
+evaluation = evaluate_model(f'outputs/{args.modelname}.onnx', Indexed_rows(X, test_indices), Indexed_rows(y, test_indices))
+evaluation['stems'] = [manifest[index]['stem'] for index in test_indices]
+print("dice test: {}, IoU test: {}".format(evaluation['dice']['mean'], evaluation['iou']['mean']))
+log_evaluation(run, evaluation)
+with open('outputs/evaluation.json', 'w') as f:
+    json.dump(evaluation, f, indent=2)